@@ -0,0 +1,360 @@
+"""Local stand-ins for the servers rcppkg talks to
+
+Each server runs on a thread on a free localhost port and only implements
+what rcppkg uses: the GitLab group projects API, a Koji XML-RPC hub and a
+lookaside cache with Apache style index pages and an rpkg upload CGI.
+"""
+import hashlib
+import json
+import socket
+import sys
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, urlparse
+from six.moves.xmlrpc_server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on purpose, e.g. when aborting an upload
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class QuietHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_type='text/plain', status=200, headers=None):
+        body = body.encode('utf-8') if not isinstance(body, bytes) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+class StandIn(object):
+    def start(self, server):
+        self.server = server
+        self.thread = threading.Thread(target=server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class FakeGitLab(StandIn):
+    """GitLab v4 API with one group of projects named package-<n>"""
+
+    def __init__(self, projects, group_id=1, latency=0.0):
+        now = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+        self.group = {'id': group_id, 'name': 'specs', 'path': 'specs', 'full_path': 'specs'}
+        self.projects = [{'id': n, 'name': 'package-%d' % n, 'path': 'package-%d' % n,
+                          'last_activity_at': now} for n in range(projects)]
+        self.requests = 0
+        stand_in = self
+
+        class Handler(QuietHandler):
+            def do_GET(self):
+                stand_in.requests += 1
+                time.sleep(latency)
+                url = urlparse(self.path)
+                query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+                group_path = '/api/v4/groups/%s' % group_id
+                if url.path == group_path:
+                    self.send_body(json.dumps(stand_in.group), 'application/json')
+                elif url.path == group_path + '/projects':
+                    self.send_projects(url.path, query)
+                else:
+                    self.send_body('{"message": "404 Not Found"}', 'application/json', 404)
+
+            def send_projects(self, path, query):
+                projects = stand_in.projects
+                if 'last_activity_after' in query:
+                    projects = [p for p in projects
+                                if p['last_activity_at'] > query['last_activity_after']]
+                per_page = min(int(query.get('per_page', 20)), 100)
+                page = int(query.get('page', 1))
+                total_pages = max(1, (len(projects) + per_page - 1) // per_page)
+                headers = {'X-Page': str(page), 'X-Per-Page': str(per_page),
+                           'X-Total': str(len(projects)), 'X-Total-Pages': str(total_pages)}
+                if page < total_pages:
+                    query = dict(query, page=page + 1)
+                    headers['X-Next-Page'] = str(page + 1)
+                    headers['Link'] = '<%s%s?%s>; rel="next"' % (
+                        stand_in.url, path, '&'.join('%s=%s' % item for item in sorted(query.items())))
+                start = (page - 1) * per_page
+                self.send_body(json.dumps(projects[start:start + per_page]), 'application/json',
+                               headers=headers)
+
+        self.start(ThreadingHTTPServer(('127.0.0.1', 0), Handler))
+
+
+class KojiHandler(SimpleXMLRPCRequestHandler):
+    rpc_paths = ('/kojihub', '/RPC2')
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingXMLRPCServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class FakeKojiHub(StandIn):
+    """Koji hub building every package instantly and successfully
+
+    tasks maps task ids to their (info, children) for tests that need
+    tasks in other states; other tasks it created are closed builds and
+    ids it never handed out are unknown.
+    """
+
+    def __init__(self, target='dist-foo', latency=0.0):
+        self.target = target
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.next_task = 1000
+        self.event = 1
+        self.calls = 0
+
+        server = ThreadingXMLRPCServer(('127.0.0.1', 0), requestHandler=KojiHandler,
+                                       allow_none=True, logRequests=False)
+        for name in ('getBuildTarget', 'getTag', 'getFullInheritance', 'getRepo',
+                     'getLastEvent', 'getTaskInfo', 'getTaskChildren', 'build',
+                     'getLoggedInUser'):
+            server.register_function(self.hub_call(getattr(self, name)), name)
+        server.register_function(self.hub_call(self.multiCall), 'multiCall')
+        self.start(server)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/kojihub' % self.server.server_address[1]
+
+    def hub_call(self, method):
+        def call(*args):
+            with self.lock:
+                self.calls += 1
+            time.sleep(self.latency)
+            return self.dispatch(method, args)
+        return call
+
+    def dispatch(self, method, args):
+        # Koji passes keyword arguments as a marked dict after the others
+        kwargs = {}
+        if args and isinstance(args[-1], dict) and args[-1].get('__starstar'):
+            kwargs = dict(args[-1])
+            del kwargs['__starstar']
+            args = args[:-1]
+        return method(*args, **kwargs)
+
+    def multiCall(self, calls):
+        results = []
+        for call in calls:
+            try:
+                method = getattr(self, call['methodName'])
+                results.append([self.dispatch(method, tuple(call['params']))])
+            except Exception as e:
+                results.append({'faultCode': 1000, 'faultString': str(e)})
+        return results
+
+    def getBuildTarget(self, name, *args):
+        if name != self.target:
+            return None
+        return {'id': 1, 'name': name, 'build_tag': 1, 'build_tag_name': '%s-build' % name,
+                'dest_tag': 2, 'dest_tag_name': name}
+
+    def getTag(self, name, *args):
+        return {'id': 2, 'name': name, 'locked': False, 'arches': 'x86_64', 'perm': None}
+
+    def getFullInheritance(self, tag, *args):
+        return []
+
+    def getRepo(self, tag, *args):
+        return {'id': 1, 'create_event': self.event, 'state': 1}
+
+    def getLastEvent(self, *args):
+        return {'id': self.event, 'ts': time.time()}
+
+    def getLoggedInUser(self):
+        return {'id': 1, 'name': 'bench'}
+
+    def build(self, src, target, opts=None, priority=None, channel=None):
+        with self.lock:
+            self.next_task += 1
+            self.event += 1
+            return self.next_task
+
+    def getTaskInfo(self, task_id, *args):
+        if task_id in self.tasks:
+            return self.tasks[task_id][0]
+        if task_id > self.next_task:
+            return None
+        return {'id': task_id, 'state': 2, 'method': 'build'}
+
+    def getTaskChildren(self, task_id, *args):
+        return self.tasks.get(task_id, (None, []))[1]
+
+
+def iter_content(name, size):
+    """Deterministic content of a synthetic source file"""
+    block = hashlib.sha512(name.encode('utf-8')).digest() * (CHUNK_SIZE // 64)
+    remaining = size
+    while remaining > 0:
+        chunk = block[:min(remaining, len(block))]
+        remaining -= len(chunk)
+        yield chunk
+
+
+def content_hash(name, size, hashtype='sha512'):
+    hasher = hashlib.new(hashtype)
+    for chunk in iter_content(name, size):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def parse_multipart(body, boundary):
+    """Fields of a multipart/form-data body, the file field as bytes
+
+    Returns None if the closing boundary is missing.
+    """
+    delimiter = b'--' + boundary.encode('utf-8')
+    parts = body.split(b'\r\n' + delimiter)
+    if not parts[0].startswith(delimiter) or not parts[-1].startswith(b'--'):
+        return None
+
+    fields = {}
+    for part in [parts[0][len(delimiter):]] + parts[1:-1]:
+        head, _, value = part.partition(b'\r\n\r\n')
+        name = None
+        for line in head.decode('utf-8').split('\r\n'):
+            if line.lower().startswith('content-disposition:'):
+                for param in line.split(';')[1:]:
+                    key, _, param_value = param.strip().partition('=')
+                    if key == 'name':
+                        name = param_value.strip('"')
+        if name == 'file':
+            fields[name] = value
+        elif name:
+            fields[name] = value.decode('utf-8')
+    return fields
+
+
+class FakeLookaside(StandIn):
+    """Lookaside cache at /repo/pkgs with an rpkg style upload CGI at /upload.cgi
+
+    files maps package names to lists of (file name, size). Every file is
+    stored at <package>/<file>/sha512/<hash>/<file>, its content is
+    generated on the fly. Uploads are checksummed and then discarded.
+    """
+
+    def __init__(self, files, latency=0.0):
+        self.latency = latency
+        self.files = {}
+        self.tree = {}
+        for package, package_files in files.items():
+            for name, size in package_files:
+                digest = content_hash('%s/%s' % (package, name), size)
+                path = '/repo/pkgs/%s/%s/sha512/%s/%s' % (package, name, digest, name)
+                self.files[path] = ('%s/%s' % (package, name), size)
+                self.add_to_tree(path)
+        self.uploaded = set()
+        self.requests = 0
+        stand_in = self
+
+        class Handler(QuietHandler):
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                stand_in.requests += 1
+                time.sleep(stand_in.latency)
+                path = urlparse(self.path).path
+                if path in stand_in.files:
+                    self.send_file(*stand_in.files[path])
+                elif path.endswith('/') and path in stand_in.tree:
+                    self.send_body(stand_in.index_page(path), 'text/html')
+                else:
+                    self.send_body('Not Found', status=404)
+
+            def send_file(self, name, size):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                if self.command == 'GET':
+                    for chunk in iter_content(name, size):
+                        self.wfile.write(chunk)
+
+            def do_POST(self):
+                stand_in.requests += 1
+                time.sleep(stand_in.latency)
+                form = self.read_form()
+                if form is None:
+                    self.send_body('Incomplete request', status=400)
+                    return
+                key = (form.get('name'), form.get('filename'), form.get('sha512sum'))
+                if 'file' not in form:
+                    self.send_body('Available' if key in stand_in.uploaded else 'Missing')
+                    return
+                if hashlib.sha512(form['file']).hexdigest() != key[2]:
+                    self.send_body('Checksum mismatch', status=400)
+                    return
+                stand_in.uploaded.add(key)
+                self.send_body('File %s stored OK' % key[1])
+
+            def read_form(self):
+                """The posted fields, None if the client gave up sending them"""
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                if len(body) != length:
+                    return None
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('multipart/form-data'):
+                    boundary = content_type.partition('boundary=')[2].strip('"')
+                    return parse_multipart(body, boundary)
+                return dict((key, values[0]) for key, values
+                            in parse_qs(body.decode('utf-8')).items())
+
+        self.start(ThreadingHTTPServer(('127.0.0.1', 0), Handler))
+
+    def add_to_tree(self, path):
+        parts = path.strip('/').split('/')
+        for depth in range(1, len(parts)):
+            directory = '/%s/' % '/'.join(parts[:depth])
+            child = parts[depth] + ('/' if depth < len(parts) - 1 else '')
+            self.tree.setdefault(directory, set()).add(child)
+
+    def index_page(self, path):
+        parent = path.rstrip('/').rpartition('/')[0] + '/'
+        links = ['<a href="?C=N;O=D">Name</a>', '<a href="?C=M;O=A">Last modified</a>',
+                 '<a href="%s">Parent Directory</a>' % parent]
+        links.extend('<a href="%s">%s</a>' % (child, child) for child in sorted(self.tree[path]))
+        return ('<html><head><title>Index of %s</title></head><body><h1>Index of %s</h1>\n%s\n'
+                '</body></html>' % (path, path, '<br>\n'.join(links)))
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+"""Measure the cold start time of rcppkg against a fixed budget
+
+Every case is run in a fresh interpreter several times and the median wall
+time is compared to its budget. Exits non-zero if any case is over budget.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RCPPKG = os.path.join(ROOT, 'bin', 'rcppkg')
+
+# (name, command, budget in seconds)
+CASES = [
+    ('import', [sys.executable, '-c', 'import rcppkg'], 0.4),
+    ('search --help', [sys.executable, RCPPKG, 'search', '--help'], 0.6),
+    ('unsupported command', [sys.executable, RCPPKG, 'lint'], 0.5),
+]
+
+
+def measure(cmd, runs):
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='1')
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            if subprocess.call(cmd, stdout=devnull, stderr=devnull, env=env):
+                raise RuntimeError('%s failed' % ' '.join(cmd))
+            timings.append(time.time() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiply all budgets, e.g. for slow CI hosts')
+    args = parser.parse_args()
+
+    over_budget = False
+    print('%-22s %10s %10s' % ('case', 'median', 'budget'))
+    for name, cmd, budget in CASES:
+        median = measure(cmd, args.runs)
+        budget *= args.scale
+        flag = '' if median <= budget else '  OVER BUDGET'
+        over_budget = over_budget or bool(flag)
+        print('%-22s %9.3fs %9.3fs%s' % (name, median, budget, flag))
+
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,343 @@
+#!/usr/bin/python
+"""Benchmark search, clone, new-sources and build against local stand-ins
+
+GitLab, Koji and the lookaside cache are replaced by the servers of
+bench/servers.py, so the numbers only depend on rcppkg and the host. Clone,
+new-sources and build run the Commands methods behind those commands.
+Every case is run several times and its median is compared to the baseline
+stored in bench/baselines.json, which --save-baseline (re)writes. Exits
+non-zero if a case got slower than its baseline by more than --tolerance.
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.dirname(os.path.abspath(__file__))]
+
+import servers  # noqa: E402
+import rcppkg  # noqa: E402
+import rcppkg.lookaside as rcppkg_lookaside  # noqa: E402
+import rcppkg.process as rcppkg_process  # noqa: E402
+import rcppkg.utils as rcppkg_utils  # noqa: E402
+
+from pyrpkg.errors import rpkgError  # noqa: E402
+
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+Entry = collections.namedtuple('Entry', ['file', 'hashtype', 'hash'])
+# name, seconds, items handled, bytes handled
+Result = collections.namedtuple('Result', ['name', 'seconds', 'items', 'size'])
+
+# Failures surface as exceptions, so the commands' own messages are dropped
+log = logging.getLogger('bench')
+log.addHandler(logging.NullHandler())
+log.propagate = False
+
+
+def median(timings):
+    return sorted(timings)[len(timings) // 2]
+
+
+def measure(runs, setup, run):
+    """Median wall time of run(setup()) over runs fresh setups"""
+    timings = []
+    for _ in range(runs):
+        state = setup()
+        start = time.time()
+        run(state)
+        timings.append(time.time() - start)
+    return median(timings)
+
+
+def bench_search(args, work_dir):
+    results = []
+    for packages in args.packages:
+        with servers.FakeGitLab(packages) as gitlab:
+            rcppkg_utils.GITLAB_URL = gitlab.url
+            rcppkg_utils.GITLAB_GROUP_ID = 1
+            rcppkg_utils.PROJECT_INDEX_PATH = os.path.join(work_dir, 'projects-%d.json' % packages)
+
+            def cold():
+                if os.path.exists(rcppkg_utils.PROJECT_INDEX_PATH):
+                    os.remove(rcppkg_utils.PROJECT_INDEX_PATH)
+
+            seconds = measure(args.runs, cold,
+                              lambda state: rcppkg_utils.get_matching_packages('package-1'))
+            results.append(Result('search cold packages=%d' % packages, seconds, packages, 0))
+            seconds = measure(args.runs, lambda: None,
+                              lambda state: rcppkg_utils.get_matching_packages('package-1'))
+            results.append(Result('search warm packages=%d' % packages, seconds, packages, 0))
+    return results
+
+
+class BenchCommands(rcppkg.Commands):
+    """Commands working below the benchmark's work directory"""
+
+    @property
+    def build_dir(self):
+        return self.bench_dir
+
+
+def make_commands(build_dir, args, lookaside_url='http://127.0.0.1:1', cgi_url=''):
+    """Commands configured like load_cmd does with build_dir as build directory
+
+    They are created as for build-many, which sets nothing up on creation.
+    """
+    cmd = BenchCommands(build_dir,
+                        '%s/repo/pkgs' % lookaside_url,
+                        'sha512',
+                        cgi_url,
+                        'git+https://git.example.com/%(module)s.git',
+                        'https://git.example.com/%(module)s.git',
+                        'master',
+                        os.path.join(build_dir, 'koji.conf'),
+                        'koji',
+                        quiet=True,
+                        command='build-many')
+    cmd.bench_dir = build_dir
+    cmd.log = log
+    cmd.clone_config = None
+    cmd.download_workers = args.workers
+    cmd.use_cache = False
+    cmd.source_cache_dir = os.path.join(build_dir, 'source-cache')
+    cmd.source_cache_size = rcppkg_utils.parse_size('20G')
+    return cmd
+
+
+@contextmanager
+def quiet():
+    """Keep the progress messages and tables of the commands off the results"""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def source_entries(lookaside, package):
+    # Paths are /repo/pkgs/<package>/<file>/sha512/<hash>/<file>
+    return [Entry(path.split('/')[-1], 'sha512', path.split('/')[-2])
+            for path in sorted(lookaside.files)
+            if path.startswith('/repo/pkgs/%s/' % package)]
+
+
+def write_sources(module_build_dir, entries):
+    if not os.path.exists(module_build_dir):
+        os.makedirs(module_build_dir)
+    with open(os.path.join(module_build_dir, 'sources'), 'w') as f:
+        for entry in entries:
+            f.write('%s (%s) = %s\n' % (entry.hashtype.upper(), entry.file, entry.hash))
+
+
+def lookaside_files(args, size):
+    return {'bench': [('source-%d.tar.gz' % n, size) for n in range(args.files)]}
+
+
+def bench_clone(args, work_dir):
+    """Check out the sources of a package through the source cache with clone"""
+    results = []
+    for size in args.file_sizes:
+        with servers.FakeLookaside(lookaside_files(args, size)) as lookaside:
+            cmd = make_commands(work_dir, args, lookaside.url)
+            write_sources(os.path.join(work_dir, 'bench'), source_entries(lookaside, 'bench'))
+            cmd.path = os.path.join(work_dir, 'checkouts')
+
+            def fresh(empty_cache):
+                if empty_cache:
+                    shutil.rmtree(cmd.source_cache.root, ignore_errors=True)
+                shutil.rmtree(cmd.path, ignore_errors=True)
+                os.makedirs(cmd.path)
+                # clone creates the checkout in the current directory
+                os.chdir(cmd.path)
+
+            def clone(state):
+                with quiet():
+                    cmd.clone('bench')
+
+            try:
+                seconds = measure(args.runs, lambda: fresh(True), clone)
+                results.append(Result('clone cold files=%d size=%s'
+                                      % (args.files, rcppkg_utils.format_size(size)),
+                                      seconds, args.files, args.files * size))
+                seconds = measure(args.runs, lambda: fresh(False), clone)
+                results.append(Result('clone warm files=%d size=%s'
+                                      % (args.files, rcppkg_utils.format_size(size)),
+                                      seconds, args.files, 0))
+            finally:
+                os.chdir(work_dir)
+    return results
+
+
+def bench_new_sources(args, work_dir):
+    """Find sources in the Fedora style lookaside and upload the missing ones"""
+    results = []
+    for size in args.file_sizes:
+        with servers.FakeLookaside(lookaside_files(args, size)) as lookaside:
+            # The stand-in is both the Fedora lookaside and ours
+            rcppkg_lookaside.FEDORA_LOOKASIDE_URL = '%s/repo/pkgs' % lookaside.url
+            cmd = make_commands(work_dir, args, lookaside.url, '%s/upload.cgi' % lookaside.url)
+            cmd.module_name = 'bench'
+            module_build_dir = os.path.join(work_dir, 'bench')
+            entries = source_entries(lookaside, 'bench')
+
+            def upload(state):
+                with quiet():
+                    cmd.upload([])
+
+            write_sources(module_build_dir, entries)
+            seconds = measure(args.runs, lookaside.uploaded.clear, upload)
+            results.append(Result('new-sources files=%d size=%s'
+                                  % (args.files, rcppkg_utils.format_size(size)),
+                                  seconds, args.files, args.files * size))
+
+            # For a hash that isn't in the tree the crawler walks all of the
+            # file's directory, the copy it finds fails the checksum
+            write_sources(module_build_dir, [entries[0]._replace(hash='0' * 128)])
+
+            def crawl(state):
+                try:
+                    upload(state)
+                except rpkgError:
+                    return
+                raise RuntimeError('upload found a source that does not exist')
+
+            seconds = measure(args.runs, lambda: None, crawl)
+            results.append(Result('new-sources crawl files=%d size=%s'
+                                  % (args.files, rcppkg_utils.format_size(size)),
+                                  seconds, 1, 0))
+    return results
+
+
+def make_spec_repo(path):
+    """Spec file repository that is its own origin, so it is never behind"""
+    os.makedirs(path)
+    with open(os.path.join(path, 'bench.spec'), 'w') as f:
+        f.write('Name: bench\nVersion: 1.0\nRelease: 1\nSummary: Benchmark\nLicense: MIT\n')
+    for argv in (['git', 'init', '-q'],
+                 ['git', 'add', 'bench.spec'],
+                 ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@example.com',
+                  'commit', '-q', '-m', 'Benchmark spec'],
+                 ['git', 'remote', 'add', 'origin', path]):
+        rcppkg_process.run(argv, cwd=path)
+
+
+def bench_build(args, work_dir):
+    """Submit builds of many packages at once with build-many"""
+    try:
+        import koji
+    except ImportError:
+        print('Skipping build submission, koji is not installed')
+        return []
+
+    template = os.path.join(work_dir, 'spec-template')
+    make_spec_repo(template)
+
+    results = []
+    with servers.FakeKojiHub() as hub:
+        for packages in args.build_packages:
+            build_dir = os.path.join(work_dir, 'build-%d' % packages)
+            names = ['package-%d' % n for n in range(packages)]
+            for name in names:
+                shutil.copytree(template, os.path.join(build_dir, name))
+            cmd = make_commands(build_dir, args)
+            cmd._kojisession = koji.ClientSession(hub.url)
+
+            def build_many(state):
+                with quiet():
+                    submitted = cmd.build_many([(name, None) for name in names])
+                if not all(task_id for package, task_id in submitted):
+                    raise RuntimeError('Not all builds were submitted')
+
+            seconds = measure(args.runs, lambda: None, build_many)
+            results.append(Result('build-many packages=%d' % packages, seconds, packages, 0))
+    return results
+
+
+BENCHMARKS = collections.OrderedDict([
+    ('search', bench_search),
+    ('clone', bench_clone),
+    ('new-sources', bench_new_sources),
+    ('build', bench_build),
+])
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def size_list(value):
+    return [rcppkg_utils.parse_size(item) for item in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Benchmarks to run out of %s, all of them by default'
+                             % ', '.join(BENCHMARKS))
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--packages', type=int_list, default=[1000, 5000],
+                        help='Comma separated package counts for search')
+    parser.add_argument('--build-packages', type=int_list, default=[50, 200],
+                        help='Comma separated package counts for build, every '
+                             'package gets a spec file repository')
+    parser.add_argument('--files', type=int, default=10,
+                        help='Number of source files for clone and new-sources')
+    parser.add_argument('--file-sizes', type=size_list, default=[64 * 1024, 16 * 1024 * 1024],
+                        help='Comma separated source file sizes, e.g. 64K,16M')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown against the baseline, 0.25 is 25%%')
+    parser.add_argument('--save-baseline', action='store_true', default=False,
+                        help='Store the results as the new baseline')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %s' % name)
+
+    work_dir = tempfile.mkdtemp(prefix='rcppkg-bench-')
+    rcppkg_utils.CACHE_DIR = work_dir
+    try:
+        results = []
+        for name in args.benchmarks or BENCHMARKS:
+            results.extend(BENCHMARKS[name](args, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baselines = rcppkg_utils.read_json(BASELINES) or {}
+    regressed = False
+    print('%-36s %10s %12s %10s %10s' % ('case', 'median', 'items/s', 'MB/s', 'baseline'))
+    for result in results:
+        baseline = baselines.get(result.name)
+        flag = ''
+        if baseline and result.seconds > baseline * (1 + args.tolerance):
+            flag = '  SLOWER'
+            regressed = True
+        print('%-36s %9.3fs %12.1f %10s %10s%s'
+              % (result.name, result.seconds, result.items / max(result.seconds, 1e-9),
+                 '%.1f' % (result.size / max(result.seconds, 1e-9) / 1024 / 1024)
+                 if result.size else '-',
+                 '%.3fs' % baseline if baseline else '-', flag))
+
+    if args.save_baseline:
+        baselines.update((result.name, result.seconds) for result in results)
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        return 0
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
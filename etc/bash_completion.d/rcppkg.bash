@@ -32,11 +32,11 @@ _rpkg()
 
     # global options
 
-    local options="--help -v -q"
-    local options_value="--dist --release --user --path"
-    local commands="build chain-build ci clean clog clone co container-build container-build-config commit compile copr-build diff gimmespec giturl help \
+    local options="--help -v -q --no-cache --profile"
+    local options_value="--dist --release --user --path --profile-trace"
+    local commands="build build-many chain-build ci clean clog clone co container-build container-build-config commit compile copr-build diff gimmespec giturl help \
     gitbuildhash import install lint local mockbuild mock-config new new-sources patch prep pull push scratch-build sources \
-    srpm switch-branch tag unused-patches upload verify-files verrel search"
+    srpm switch-branch tag unused-patches upload verify-files verrel search cache-stats cache-prune prefetch"
 
     # parse main options and get command
 
@@ -80,6 +80,9 @@ _rpkg()
             --path)
                 _filedir_exclude_paths
                 ;;
+            --profile-trace)
+                _filedir
+                ;;
             *)
                 COMPREPLY=( $(compgen -W "$commands" -- "$cur") )
                 ;;
@@ -103,9 +106,16 @@ _rpkg()
             options_srpm="--srpm"
             options_target="--target"
             ;;
+        build-many)
+            options="--nowait --background --skip-tag --scratch --fail-fast"
+            options_file="--manifest"
+            options_target="--target"
+            after_more=true
+            ;;
         chain-build)
-            options="--nowait --background"
+            options="--background --dry-run"
             options_target="--target"
+            options_string="--max-parallel"
             after="package"
             after_more=true
             ;;
@@ -170,8 +180,9 @@ _rpkg()
             options_arch="--arch"
             ;;
         mockbuild)
-            options="--md5 --no-clean --no-cleanup-after --no-clean-all"
+            options="--md5 --no-clean --no-cleanup-after --no-clean-all --offline"
             options_mroot="--root"
+            options_string="--matrix"
             ;;
         patch)
             options="--rediff"
@@ -214,8 +225,16 @@ _rpkg()
             after_more=true
             ;;
         search)
+            options="--refresh"
             after_more=true
             ;;
+        cache-prune)
+            options_string="--max-size"
+            ;;
+        prefetch)
+            options="--watch"
+            options_string="--workers --max-rate --interval"
+            ;;
     esac
 
     local all_options="--help $options"
@@ -1,37 +1,45 @@
-import git
-import koji
+import hashlib
+import json
+import multiprocessing
 import os
 import pyrpkg
+import re
 import shutil
-import subprocess
 import sys
-import wget
+import time
 
+import rcppkg.process as rcppkg_process
+import rcppkg.spec as rcppkg_spec
+import rcppkg.timing as rcppkg_timing
 import rcppkg.utils as rcppkg_utils
 
 from . import cli
-from distutils.dir_util import copy_tree
+from multiprocessing.pool import ThreadPool
+from six.moves import input
 from pyrpkg.sources import SourcesFile
+from rcppkg.sourcecache import SourceCache, link_or_copy
 from pyrpkg.errors import HashtypeMixingError, rpkgError, rpkgAuthError, UnknownTargetError
 
 
 class Commands(pyrpkg.Commands):
     def __init__(self, path, lookaside, lookasidehash, lookaside_cgi,
                  gitbaseurl, anongiturl, branchre, kojiconfig,
-                 build_client, **kwargs):
-
-        # Disable commands that haven't been tested/modified to work
-        supported_commands = ['build', 'clone', 'container-build', 'mockbuild', 'new-sources', 'search']
-        if sys.argv[1] not in supported_commands:
-            print("This command is not supported yet. Use one of the following:")
-            print(supported_commands)
-            exit(0)
+                 build_client, remote_check_ttl=rcppkg_utils.REMOTE_CHECK_TTL,
+                 offline=False, command=None, gitlab_per_page=rcppkg_utils.GITLAB_PER_PAGE,
+                 gitlab_workers=rcppkg_utils.GITLAB_WORKERS, **kwargs):
 
         super(Commands, self).__init__(path, lookaside, lookasidehash,
                                        lookaside_cgi, gitbaseurl, anongiturl,
                                        branchre, kojiconfig, build_client,
                                        **kwargs)
-        if sys.argv[1] != 'search':
+        self.remote_check_ttl = remote_check_ttl
+        self.gitlab_per_page = gitlab_per_page
+        self.gitlab_workers = gitlab_workers
+        self.offline = offline
+        # Name of the command being run, as found by the client
+        self.command = command
+        if command not in ['search', 'cache-stats', 'cache-prune', 'prefetch',
+                           'build-many', 'chain-build']:
             self.setup_build_env()
 
     @property
@@ -48,6 +56,14 @@ class Commands(pyrpkg.Commands):
     def mock_results_dir(self):
         return os.path.join(self.module_build_dir, "results_%s" % self.module_name, self.ver, self.rel)
 
+    @property
+    def mock_config_dir(self):
+        return os.path.join(self.build_dir, "mock-configs")
+
+    @property
+    def mock_pool_dir(self):
+        return os.path.join(self.build_dir, "mock-chroots")
+
     @property
     def target(self):
         """This property ensures the target attribute"""
@@ -63,29 +79,61 @@ class Commands(pyrpkg.Commands):
         return self.gitbaseurl % {'module': self.module_name}
 
 
-    def search_packages(self, search_word):
-        matches = rcppkg_utils.get_matching_packages(search_word)
+    def _run_command(self, cmd, *args, **kwargs):
+        program = cmd[0] if isinstance(cmd, list) else cmd.split()[0]
+        with rcppkg_timing.span('run %s' % os.path.basename(program)):
+            return super(Commands, self)._run_command(cmd, *args, **kwargs)
+
+    def run_process(self, argv, capture=False, **kwargs):
+        """Run argv through rcppkg.process, failures raise rpkgError"""
+        try:
+            return rcppkg_process.run(argv, capture=capture, log=self.log, **kwargs)
+        except rcppkg_process.ProcessError as e:
+            raise rpkgError(str(e))
+
+    def search_packages(self, search_word, refresh=False):
+        matches = rcppkg_utils.get_matching_packages(search_word, refresh,
+                                                     self.gitlab_per_page, self.gitlab_workers)
         for match in matches:
-            print(match.name)
+            print(match['name'])
 
         exit(0)
 
 
-    def setup_build_env(self):
+    @rcppkg_timing.timed('setup_build_env')
+    def setup_build_env(self, interactive=True):
+        """Make sure the spec file repository of the module is cloned
+
+        Batch commands pass interactive=False: problems then raise rpkgError
+        instead of exiting, and newer remote commits are only warned about.
+        """
+        if self.offline:
+            if not os.path.exists(self.module_build_dir):
+                raise rpkgError('No local copy of %s to work on offline' % self.module_name)
+            return
+
         if not os.path.exists(self.module_build_dir):
             print("Fetching package list...")
-            repo = rcppkg_utils.get_repository(self.module_name)
+            repo = rcppkg_utils.get_repository(self.module_name, False,
+                                               self.gitlab_per_page, self.gitlab_workers)
             if not repo:
+                if not interactive:
+                    raise rpkgError("Spec file repository with name '%s' does not exist"
+                                    % self.module_name)
                 print("Spec file repository with name '%s' does not exists." % self.module_name)
                 exit(0)
 
         print("Checking build environment...")
-        if rcppkg_utils.remote_updates_available(self.module_build_dir):
-            print("There are newer commits available in spec file repository remote.")
-            question = "Do you want to abort this operation to go and fetch the latest changes?"
-            if raw_input("%s (y/N) " % question).lower() == 'y':
-                print("Aboring operation.")
-                exit(0)
+        if rcppkg_utils.remote_updates_available(self.module_build_dir, self.remote_check_ttl):
+            if not interactive:
+                self.log.warning('There are newer commits available in the spec file '
+                                 'repository remote of %s.', self.module_name)
+            else:
+                print("There are newer commits available in spec file repository remote.")
+                question = "Do you want to abort this operation to go and fetch the latest changes?"
+                if input("%s (y/N) " % question).lower() == 'y':
+                    print("Aboring operation.")
+                    exit(0)
 
         if not os.path.exists(self.build_dir):
             os.mkdir(self.build_dir)
@@ -93,17 +141,34 @@ class Commands(pyrpkg.Commands):
             os.mkdir(self.module_build_dir)
 
             try:
-                os.system('git -C %s clone %s' % (self.build_dir, self.spec_file_git))
-            except Exception as e:
+                self.clone_spec_repo()
+            except rpkgError:
                 shutil.rmtree(self.module_build_dir)
+                if not interactive:
+                    raise rpkgError('Could not clone the spec file repository of %s'
+                                    % self.module_name)
                 self.log.info("There is no spec file for a package with this name.")
                 exit(0)
         print("Build environment set up successfully")
 
 
+    @rcppkg_timing.timed('clone_spec_repo')
+    def clone_spec_repo(self):
+        # History is kept for building older commits, file contents are
+        # only fetched for the checked out commit
+        try:
+            self.run_process(['git', 'clone', '--filter=blob:none', self.spec_file_git],
+                             cwd=self.build_dir)
+        except rpkgError:
+            self.log.debug('Partial clone failed, falling back to a full clone')
+            shutil.rmtree(self.module_build_dir)
+            os.mkdir(self.module_build_dir)
+            self.run_process(['git', 'clone', self.spec_file_git], cwd=self.build_dir)
+
+
     def load_module_name(self):
         # If cloning, the module name is given as command line argument
-        if sys.argv[1] == 'clone':
+        if self.command == 'clone':
             self._module_name = sys.argv[-1]
             return
 
@@ -143,9 +208,10 @@ class Commands(pyrpkg.Commands):
             self.log.debug('Cloning into: %s', target)
             cmd.append(target)
 
-        self._run_command(cmd, cwd=path)
+        self.run_process(cmd, cwd=path)
 
         if self.clone_config:
+            import git
             base_module = self.get_base_module(module)
             git_dir = target if target else bare_dir if bare_dir else base_module
             conf_git = git.Git(os.path.join(path, git_dir))
@@ -153,6 +219,7 @@ class Commands(pyrpkg.Commands):
 
 
 
+    @rcppkg_timing.timed('clone')
     def clone(self, module, path=None, branch=None, bare_dir=None,
               anon=False, target=None):
         """Clone a repo, optionally check out a specific branch.
@@ -187,9 +254,8 @@ class Commands(pyrpkg.Commands):
         if os.path.exists(sources_file_path):
             os.mkdir(self.module_name)
             sourcesf = self.get_source_entries()
-            for entry in sourcesf.entries:
-                os.system("wget %s/%s/%s/%s/%s/%s -P %s" % (self.lookaside, self.module_name, entry.file, entry.hashtype, entry.hash, entry.file, self.module_name))
-                rcppkg_utils.compare_checksum(entry.hashtype, entry.hash, "%s/%s/%s" % (self.path, self.module_name, entry.file))
+            target_dir = os.path.join(self.path, self.module_name)
+            self.download_sources(sourcesf.entries, target_dir)
         else:
             url = rcppkg_utils.get_git_url_from_specfile(specfile_path)
             if url[-4:] == '.git':
@@ -237,35 +303,42 @@ class Commands(pyrpkg.Commands):
         else:
             raise rpkgError('No spec file found.')
 
+    @rcppkg_timing.timed('load_nameverrel')
     def load_nameverrel(self):
         """Set the release of a package module."""
 
+        specfile_path = os.path.join(self.module_build_dir, self.spec)
+        try:
+            header = rcppkg_spec.parse_spec(specfile_path,
+                                            rcppkg_spec.parse_rpmdefines(self.rpmdefines))
+        except rcppkg_spec.SpecParseError as e:
+            # Only specs too dynamic to evaluate here need rpm itself
+            self.log.debug('Falling back to rpm to get N-V-R-E: %s', e)
+        else:
+            self._module_name_spec = header.name
+            self._epoch = header.epoch or "0"
+            self._ver = header.version
+            self._rel = header.release
+            return
+
         cmd = ['rpm']
-        cmd.extend(self.rpmdefines)
+        cmd.extend(rcppkg_process.split_options(self.rpmdefines))
         # We make sure there is a space at the end of our query so that
         # we can split it later.  When there are subpackages, we get a
         # listing for each subpackage.  We only care about the first.
-        cmd.extend(['-q', '--qf', '"%{NAME} %{EPOCH} %{VERSION} %{RELEASE}??"',
-                    '--specfile', '"%s/%s"' % (self.module_build_dir, self.spec)])
-        joined_cmd = ' '.join(cmd)
+        cmd.extend(['-q', '--qf', '%{NAME} %{EPOCH} %{VERSION} %{RELEASE}??',
+                    '--specfile', '%s/%s' % (self.module_build_dir, self.spec)])
 
         try:
-            proc = subprocess.Popen(joined_cmd, shell=True,
-                                    universal_newlines=True,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-            output, err = proc.communicate()
-        except Exception as e:
-            if err:
-                self.log.debug('Errors occoured while running following command to get N-V-R-E:')
-                self.log.debug(joined_cmd)
-                self.log.error(err)
+            result = rcppkg_process.run(cmd, check=False, log=self.log)
+        except rcppkg_process.ProcessError as e:
             raise rpkgError('Could not query n-v-r of %s: %s'
                             % (self.module_name, e))
-        if err:
+        output = result.stdout
+        if result.stderr:
             self.log.debug('Errors occoured while running following command to get N-V-R-E:')
-            self.log.debug(joined_cmd)
-            self.log.error(err)
+            self.log.debug(' '.join(cmd))
+            self.log.error(result.stderr)
 
         # Get just the output, then split it by ??, grab the first and split
         # again to get ver and rel
@@ -285,6 +358,7 @@ class Commands(pyrpkg.Commands):
             self._epoch = "0"
     
 
+    @rcppkg_timing.timed('srpm')
     def srpm(self, hashtype=None):
         """Create an srpm using hashtype from content in the module
 
@@ -294,14 +368,21 @@ class Commands(pyrpkg.Commands):
         specfile_path = '%s/%s.spec' % (self.module_build_dir, self.module_name)
         if (os.path.exists('%s/%s' % (self.module_build_dir, 'sources'))):
             sourcesf = self.get_source_entries()
+            missing = []
             for entry in sourcesf.entries:
                 source_package = "%s/%s" % (self.module_build_dir, entry.file)
-                if os.path.exists(source_package):
-                    os.remove(source_package)
-                shutil.copyfile(entry.file, source_package)
+                if os.path.exists(entry.file):
+                    link_or_copy(entry.file, source_package)
+                else:
+                    missing.append(entry)
+            # Sources not present in the working directory come from the source cache
+            self.download_sources(missing, self.module_build_dir)
         else:
             source_name = rcppkg_utils.get_source_from_specfile(self.module_name, self.ver, specfile_path)
-            rcppkg_utils.create_source_package(self.path, self.module_build_dir, specfile_path, source_name)
+            if not rcppkg_utils.create_source_package(self.path, self.module_build_dir, specfile_path,
+                                                      source_name, self.compress_level,
+                                                      self.compress_threads, self.reproducible_tarball):
+                self.log.info('Sources unchanged since %s was created, reusing it.', source_name)
 
         self.srpmname = os.path.join(self.module_build_dir,
                                      "%s-%s-%s.src.rpm"
@@ -312,7 +393,7 @@ class Commands(pyrpkg.Commands):
             self.log.debug('Srpm found, rewriting it.')
 
         cmd = ['rpmbuild']
-        cmd.extend(self.rpmdefines)
+        cmd.extend(rcppkg_process.split_options(self.rpmdefines))
         if self.quiet:
             cmd.append('--quiet')
         # Figure out which hashtype to use, if not provided one
@@ -321,19 +402,20 @@ class Commands(pyrpkg.Commands):
             hashtype = self._guess_hashtype()
         # This may need to get updated if we ever change our checksum default
         if not hashtype == 'sha256':
-            cmd.extend(["--define '_source_filedigest_algorithm %s'"
-                        % hashtype,
-                        "--define '_binary_filedigest_algorithm %s'"
-                        % hashtype])
-        cmd.extend(['--nodeps', '-bs %s/%s' % (self.module_build_dir, self.spec)])
-        self._run_command(cmd, shell=True)
+            cmd.extend(['--define', '_source_filedigest_algorithm %s' % hashtype,
+                        '--define', '_binary_filedigest_algorithm %s' % hashtype])
+        cmd.extend(['--nodeps', '-bs', '%s/%s' % (self.module_build_dir, self.spec)])
+        self.run_process(cmd)
 
+    @rcppkg_timing.timed('koji login')
     def load_kojisession(self, anon=False):
         """Initiate a koji session.
 
         The koji session can be logged in or anonymous
         """
 
+        import koji
+
         koji_config = self.read_koji_config()
 
         # save the weburl and topurl for later use as well
@@ -353,20 +435,54 @@ class Commands(pyrpkg.Commands):
         else:
             self._kojisession = session
 
-        self.login_koji_session(koji_config, self._kojisession)
+        if rcppkg_timing.enabled():
+            # Every hub call, multiCall included, goes through _callMethod
+            rcppkg_timing.time_method(self._kojisession, '_callMethod',
+                                      lambda name, *args, **kwargs: 'koji.%s' % name)
 
+        # A daemon may still have the login of an earlier command, only
+        # commands it serves have the daemon module loaded
+        rcppkg_daemon = sys.modules.get('rcppkg.daemon')
+        if rcppkg_daemon is None:
+            self.login_koji_session(koji_config, self._kojisession)
+        elif not rcppkg_daemon.reuse_koji_session(self._kojisession, koji_config['server']):
+            self.login_koji_session(koji_config, self._kojisession)
+            rcppkg_daemon.remember_koji_session(self._kojisession, koji_config['server'])
 
-    def mock_config(self, target=None, arch=None):
+        if self.use_cache:
+            from rcppkg.kojicache import CachingKojiSession
+            self._kojisession = CachingKojiSession(self._kojisession, koji_config['server'],
+                                                   self.koji_cache_ttl)
+
+
+    @rcppkg_timing.timed('mock_config')
+    def mock_config(self, target=None, arch=None, dist=None):
         """Generate a mock config based on branch data.
 
-        Can use option target and arch to override autodiscovery.
+        Can use option target, arch and dist to override autodiscovery.
         Will return the mock config file text.
+
+        Generated configs are kept under mock_config_dir and reused until the
+        repo of the build tag changes. When working offline the last config
+        generated for the target and arch is used without asking Koji.
         """
 
         if (target is None):
             target = self.target
         if (arch is None):
             arch = self.arch
+        if (dist is None):
+            dist = self.disttag
+
+        name = '-'.join((target, arch, dist))
+        last_path = os.path.join(self.mock_config_dir, '%s.last' % name)
+        if self.offline:
+            try:
+                with open(last_path) as f:
+                    return f.read()
+            except (IOError, OSError):
+                raise rpkgError('No mock config for %s has been generated yet, '
+                                'run mockbuild once without --offline' % name)
 
         # Figure out if we have a valid build target
         build_target = self.kojisession.getBuildTarget(target)
@@ -385,18 +501,132 @@ class Commands(pyrpkg.Commands):
             for line in f:
                 if 'proxy' in line:
                     proxy = line.split('=')[1]
-        # Generate the config
-        config = koji.genMockConfig('%s-%s' % (target, arch), arch,
-                                    distribution=self.disttag,
-                                    tag_name=build_target['build_tag_name'],
-                                    repoid=repoid,
-                                    topurl=self.topurl,
-                                    yum_proxy=proxy)
 
-        # Return the mess
-        return(config)
+        key = json.dumps([target, arch, repoid, proxy, dist])
+        config_path = os.path.join(self.mock_config_dir, '%s-%s-%s-%s.cfg'
+                                   % (target, arch, repoid,
+                                      hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]))
+        if os.path.exists(config_path):
+            self.log.debug('Using cached mock config %s', config_path)
+            with open(config_path) as f:
+                config = f.read()
+        else:
+            import koji
+
+            # Generate the config
+            config = koji.genMockConfig('%s-%s' % (target, arch), arch,
+                                        distribution=dist,
+                                        tag_name=build_target['build_tag_name'],
+                                        repoid=repoid,
+                                        topurl=self.topurl,
+                                        yum_proxy=proxy)
+            rcppkg_utils.write_file_atomic(config_path, config)
+
+        rcppkg_utils.write_file_atomic(last_path, config)
+        return config
+
 
+    def mock_pool(self):
+        from rcppkg.mockpool import ChrootPool
 
+        return ChrootPool(self.mock_pool_dir, self.mock_slots, self.log)
+
+    @rcppkg_timing.timed('mockbuild')
+    def mockbuild(self, mockargs=[], root=None, hashtype=None):
+        """Build the module locally in a chroot of the mock chroot pool
+
+        Chroots of the generated mock config are reused between builds, a
+        mock root given with root is used as is.
+        """
+
+        self.srpm(hashtype=hashtype)
+
+        cmd = ['mock'] + list(mockargs)
+        if self.quiet:
+            cmd.append('--quiet')
+        cmd.extend(['--resultdir', self.mock_results_dir, '--rebuild', self.srpmname])
+
+        if root:
+            self.run_process(cmd[:1] + ['-r', root] + cmd[1:])
+            return
+
+        pool = self.mock_pool()
+        config_hash = pool.prepare('%s-%s-%s' % (self.target, self.arch, self.disttag),
+                                   self.mock_config())
+        with pool.slot(config_hash) as slot:
+            self.log.debug('Building in chroot %s of mock config %s', slot.name, config_hash)
+            self.run_process(cmd[:1] + slot.mock_args() + cmd[1:])
+            slot.mark_ready()
+
+    def mock_matrix_parallel(self, builds):
+        """How many mock builds of the matrix to run at once
+
+        Every build is given mock_build_cpus cores and mock_build_memory
+        bytes of the memory currently available.
+        """
+        parallel = max(1, multiprocessing.cpu_count() // max(1, self.mock_build_cpus))
+        memory = rcppkg_utils.available_memory()
+        if memory is not None and self.mock_build_memory:
+            parallel = min(parallel, max(1, memory // self.mock_build_memory))
+        return min(parallel, builds)
+
+    @rcppkg_timing.timed('mockbuild_matrix')
+    def mockbuild_matrix(self, combos, mockargs=[], hashtype=None):
+        """Build the module locally for several (target, arch, dist) combos
+
+        The builds run concurrently in chroots of the mock chroot pool, each
+        one leaving its results and mock output in its own directory under
+        mock_results_dir. Returns True if all of them succeeded.
+        """
+
+        self.srpm(hashtype=hashtype)
+
+        pool = self.mock_pool()
+        builds = []
+        # Configs are generated up front, the Koji session isn't thread safe
+        for target, arch, dist in combos:
+            name = '-'.join((target, arch, dist or self.disttag))
+            config_hash = pool.prepare(name, self.mock_config(target, arch, dist))
+            cmd = ['mock'] + list(mockargs)
+            if dist:
+                cmd.append('--define=dist .%s' % dist)
+            results_dir = os.path.join(self.mock_results_dir, name)
+            cmd.extend(['--resultdir', results_dir, '--rebuild', self.srpmname])
+            builds.append((name, config_hash, cmd, results_dir))
+
+        def run(build):
+            name, config_hash, cmd, results_dir = build
+            if not os.path.exists(results_dir):
+                os.makedirs(results_dir)
+            start = time.time()
+            with pool.slot(config_hash) as slot:
+                self.log.info('Building %s', name)
+                with open(os.path.join(results_dir, 'mock-output.log'), 'w') as output:
+                    returncode = rcppkg_process.run(cmd[:1] + slot.mock_args() + cmd[1:],
+                                                    capture=False, stdout=output,
+                                                    stderr=output, check=False).returncode
+                if not returncode:
+                    slot.mark_ready()
+            self.log.info('%s %s', name, 'failed' if returncode else 'built')
+            return name, returncode, time.time() - start, results_dir
+
+        parallel = self.mock_matrix_parallel(len(builds))
+        self.log.info('Running %d mock builds, %d at a time', len(builds), parallel)
+        thread_pool = ThreadPool(parallel)
+        try:
+            results = thread_pool.map(run, builds)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+        print('%-40s %-7s %-8s %s' % ('Build', 'Result', 'Time', 'Results'))
+        for name, returncode, duration, results_dir in results:
+            print('%-40s %-7s %-8s %s' % (name, 'failed' if returncode else 'ok',
+                                           '%dm%02ds' % divmod(int(duration), 60), results_dir))
+        return not any(returncode for name, returncode, duration, results_dir in results)
+
+
+    @rcppkg_timing.timed('build')
     def build(self, skip_tag=False, scratch=False, background=False,
               url=None, chain=None, arches=None, sets=False, nvr_check=True):
         """Initiate a build of the module.  Available options are:
@@ -434,17 +664,7 @@ class Commands(pyrpkg.Commands):
         else:
             url += self.version_hash
 
-        # Check to see if the target is valid
-        build_target = self.kojisession.getBuildTarget(self.target)
-        if not build_target:
-            raise rpkgError('Unknown build target: %s' % self.target)
-        # see if the dest tag is locked
-        dest_tag = self.kojisession.getTag(build_target['dest_tag_name'])
-        if not dest_tag:
-            raise rpkgError('Unknown destination tag %s'
-                            % build_target['dest_tag_name'])
-        if dest_tag['locked'] and not scratch:
-            raise rpkgError('Destination tag %s is locked' % dest_tag['name'])
+        build_target, dest_tag = self.check_build_target(scratch)
         # If we're chain building, make sure inheritance works
         if chain:
             cmd.append('chain-build')
@@ -536,6 +756,156 @@ class Commands(pyrpkg.Commands):
         return task_id
 
 
+    def check_build_target(self, scratch=False):
+        """Return the build target and its destination tag if builds can be submitted"""
+
+        # Check to see if the target is valid
+        build_target = self.kojisession.getBuildTarget(self.target)
+        if not build_target:
+            raise rpkgError('Unknown build target: %s' % self.target)
+        # see if the dest tag is locked
+        dest_tag = self.kojisession.getTag(build_target['dest_tag_name'])
+        if not dest_tag:
+            raise rpkgError('Unknown destination tag %s'
+                            % build_target['dest_tag_name'])
+        if dest_tag['locked'] and not scratch:
+            raise rpkgError('Destination tag %s is locked' % dest_tag['name'])
+        return build_target, dest_tag
+
+
+    @rcppkg_timing.timed('build_many')
+    def build_many(self, packages, skip_tag=False, scratch=False, background=False):
+        """Submit builds of several packages in one go.
+
+        packages is a list of (package name, spec file commit hash) tuples,
+        the hash being None to build the latest local commit.
+
+        The target is validated once and all builds are submitted in a single
+        multicall on one session. Packages whose spec file repository can't be
+        set up are reported and left out. Returns a list of (package, task_id)
+        tuples, task_id being None for builds that could not be submitted.
+        """
+
+        self.check_build_target(scratch)
+
+        opts = {}
+        priority = None
+        if skip_tag:
+            opts['skip_tag'] = True
+        if scratch:
+            opts['scratch'] = True
+        if background:
+            priority = 5  # magic koji number :/
+
+        # (position in packages, package, url) of the builds to submit
+        urls = []
+        for position, (package, version_hash) in enumerate(packages):
+            self.module_name = package
+            try:
+                self.setup_build_env(interactive=False)
+                if version_hash is None:
+                    version_hash = rcppkg_utils.get_local_spec_head(self.module_build_dir)
+            except rpkgError as e:
+                # One broken package doesn't keep the others from being built
+                self.log.error('Could not build %s: %s', package, e)
+                continue
+            urls.append((position, package, "git+%s?#%s" % (self.spec_file_git, version_hash)))
+
+        task_ids = {}
+        if urls:
+            self.log.info('Building %d packages for %s', len(urls), self.target)
+            self.kojisession.multicall = True
+            for position, package, url in urls:
+                self.log.debug('Building %s for %s with options %s and a priority of %s',
+                               url, self.target, opts, priority)
+                self.kojisession.build(url, self.target, opts, priority=priority)
+            results = self.kojisession.multiCall()
+
+            for (position, package, url), result in zip(urls, results):
+                if isinstance(result, dict):
+                    self.log.error('Could not build %s: %s', package, result['faultString'])
+                else:
+                    task_ids[position] = result[0]
+
+        submitted = [(package, task_ids.get(position))
+                     for position, (package, version_hash) in enumerate(packages)]
+
+        print('%-40s %s' % ('Package', 'Task'))
+        for package, task_id in submitted:
+            print('%-40s %s' % (package, task_id if task_id else 'FAILED'))
+        return submitted
+
+
+    @rcppkg_timing.timed('chain_build')
+    def chain_build(self, packages, dry_run=False, background=False, max_parallel=0):
+        """Build packages in the order their BuildRequires dictate.
+
+        BuildRequires and Provides are read from the spec files in build_dir
+        and the packages are grouped into layers that can be built in
+        parallel. Unless dry_run is set, each package is submitted as soon as
+        the packages it needs are built and available in the build tag.
+
+        Returns True if all packages were built.
+        """
+        import rcppkg.chain as rcppkg_chain
+
+        dependencies = {}
+        urls = {}
+        failed = {}
+        for package in packages:
+            self.module_name = package
+            try:
+                self.setup_build_env(interactive=False)
+                specfile_path = os.path.join(self.module_build_dir, '%s.spec' % package)
+                with open(specfile_path) as specfile:
+                    dependencies[package] = rcppkg_spec.parse_dependencies(
+                        specfile.read(), rcppkg_spec.parse_rpmdefines(self.rpmdefines))
+            except (rpkgError, IOError) as e:
+                # The rest of the chain is still built, only packages
+                # needing this one are skipped. Its spec can't be read, so
+                # it is only known to provide its own name.
+                self.log.error('Could not build %s: %s', package, e)
+                failed[package] = (None, 'setup failed')
+                dependencies[package] = rcppkg_spec.SpecDependencies()
+                dependencies[package].provides.add(package)
+                continue
+            urls[package] = "git+%s?#%s" % (self.spec_file_git,
+                                            rcppkg_utils.get_local_spec_head(self.module_build_dir))
+
+        graph = rcppkg_chain.build_graph(dependencies)
+        layers = rcppkg_chain.build_layers(graph)
+        print('Build plan for %s:' % self.target)
+        for number, layer in enumerate(layers, 1):
+            print('%4d: %s' % (number, ' '.join(layer)))
+        if dry_run:
+            return not failed
+
+        build_target, dest_tag = self.check_build_target()
+        # Packages are only available to later builds if the build tag
+        # inherits the destination tag
+        ancestors = self.kojisession.getFullInheritance(build_target['build_tag'])
+        ancestors = [ancestor['parent_id'] for ancestor in ancestors]
+        if dest_tag['id'] not in [build_target['build_tag']] + ancestors:
+            raise rpkgError('Packages in destination tag '
+                            '%(dest_tag_name)s are not inherited by '
+                            'build tag %(build_tag_name)s' %
+                            build_target)
+
+        scheduler = rcppkg_chain.ChainScheduler(self.kojisession, self.target,
+                                                build_target['build_tag_name'], graph, urls,
+                                                priority=5 if background else None,
+                                                max_parallel=max_parallel, log=self.log,
+                                                failed=failed)
+        results = scheduler.run()
+
+        print('%-40s %-10s %s' % ('Package', 'Task', 'Result'))
+        for package in packages:
+            task_id, result = results.get(package, (None, 'not built'))
+            print('%-40s %-10s %s' % (package, task_id or '-', result))
+        return all(result == 'built' for task_id, result in results.values()) \
+            and len(results) == len(packages)
+
+
     def container_build_koji(self, target_override=False, opts={},
                                  kojiconfig=None, build_client=None,
                                  koji_task_watcher=None,
@@ -604,6 +974,117 @@ class Commands(pyrpkg.Commands):
             self.load_kojisession()
 
 
+    @property
+    def source_cache(self):
+        if not hasattr(self, '_source_cache'):
+            cache_dir = self.source_cache_dir or os.path.join(self.build_dir, 'source-cache')
+            self._source_cache = SourceCache(cache_dir, self.source_cache_size)
+        return self._source_cache
+
+
+    def lookaside_url(self, module_name, entry):
+        return "%s/%s/%s/%s/%s/%s" % (self.lookaside, module_name, entry.file,
+                                      entry.hashtype, entry.hash, entry.file)
+
+    @rcppkg_timing.timed('download_sources')
+    def download_sources(self, entries, target_dir):
+        """Link sources file entries into target_dir
+
+        Entries missing from the shared source cache are downloaded into it
+        from the lookaside first.
+        """
+        import rcppkg.download as rcppkg_download
+
+        downloads = []
+        for entry in entries:
+            if self.source_cache.has(entry.hashtype, entry.hash):
+                continue
+            url = self.lookaside_url(self.module_name, entry)
+            downloads.append(rcppkg_download.Download(url,
+                                                      self.source_cache.prepare(entry.hashtype, entry.hash),
+                                                      entry.hashtype, entry.hash))
+
+        failed = []
+        for download, error in rcppkg_download.download_all(downloads, self.download_workers):
+            if error:
+                self.log.error('Failed to download %s: %s', download.url, error)
+                failed.append(download.url.split('/')[-1])
+            else:
+                self.log.info('Downloaded %s', download.url)
+
+        if failed:
+            raise rpkgError('Could not download sources: %s' % ', '.join(failed))
+
+        for entry in entries:
+            self.source_cache.link(entry.hashtype, entry.hash, os.path.join(target_dir, entry.file))
+        self.source_cache.prune()
+
+
+    def prefetch_entries(self):
+        """Sources file entries of all packages in build_dir, one per hash"""
+        entries = {}
+        for module_name in sorted(os.listdir(self.build_dir)):
+            sources_file = os.path.join(self.build_dir, module_name, 'sources')
+            if not os.path.isfile(sources_file):
+                continue
+            try:
+                sourcesf = SourcesFile(sources_file, self.source_entry_type)
+            except Exception as e:
+                self.log.warning('Skipping %s: %s', sources_file, e)
+                continue
+            for entry in sourcesf.entries:
+                entries.setdefault((entry.hashtype, entry.hash), (module_name, entry))
+        return [entries[key] for key in sorted(entries)]
+
+    @rcppkg_timing.timed('prefetch')
+    def prefetch(self, workers=None, max_rate=None):
+        """Download the sources of all packages in build_dir into the source cache
+
+        Files another process is downloading are left to it. Returns True
+        if nothing failed to download.
+        """
+        import rcppkg.download as rcppkg_download
+
+        entries = self.prefetch_entries()
+        downloads = [rcppkg_download.Download(self.lookaside_url(module_name, entry),
+                                              self.source_cache.prepare(entry.hashtype, entry.hash),
+                                              entry.hashtype, entry.hash)
+                     for module_name, entry in entries
+                     if not self.source_cache.has(entry.hashtype, entry.hash)]
+        if not downloads:
+            self.log.info('All %d source files are cached', len(entries))
+            return True
+
+        self.log.info('Fetching %d of %d source files', len(downloads), len(entries))
+        failed = 0
+        for download, error in rcppkg_download.download_all(downloads,
+                                                            workers or self.download_workers,
+                                                            max_rate=max_rate, wait=False):
+            if isinstance(error, rcppkg_download.DownloadLocked):
+                self.log.info('Skipping %s, another process is downloading it', download.url)
+            elif error:
+                self.log.error('Failed to download %s: %s', download.url, error)
+                failed += 1
+            else:
+                self.log.info('Downloaded %s', download.url)
+
+        self.source_cache.prune()
+        return not failed
+
+    def source_cache_stats(self):
+        count, size, linked = self.source_cache.stats()
+        print("Source cache: %s" % self.source_cache.root)
+        print("Entries: %d" % count)
+        print("Size: %s of %s" % (rcppkg_utils.format_size(size),
+                                  rcppkg_utils.format_size(self.source_cache_size)))
+        print("Linked from workspaces: %s" % rcppkg_utils.format_size(linked))
+
+
+    def prune_source_cache(self, max_size=None):
+        removed, freed = self.source_cache.prune(max_size)
+        print("Removed %d entries, freed %s" % (removed, rcppkg_utils.format_size(freed)))
+
+
     def get_source_entries(self):
         sources_file = "%s/sources" % self.module_build_dir
 
@@ -614,15 +1095,53 @@ class Commands(pyrpkg.Commands):
         return SourcesFile(sources_file, self.source_entry_type)
 
 
+    @rcppkg_timing.timed('upload')
     def upload(self, packages, replace=False):
         """Upload source file(s) in the lookaside cache
 
         Can optionally replace the existing tracked sources
         """
-        FEDORA_PACKAGE_BASE_URL = "http://pkgs.fedoraproject.org/repo/pkgs"
+        import rcppkg.download as rcppkg_download
+        import rcppkg.lookaside as rcppkg_lookaside
 
         package = self.module_name
-        fedora_package_url = "%s/%s/" % (FEDORA_PACKAGE_BASE_URL, package)
+        fedora_package_url = "%s/%s/" % (rcppkg_lookaside.FEDORA_LOOKASIDE_URL, package)
+        native = self.lookaside_cgi.startswith(('http://', 'https://'))
+
+        sourcesf = self.get_source_entries()
+        session = rcppkg_download.get_http_session(self.download_workers)
+        entries = sourcesf.entries
+        if native:
+            entries = rcppkg_lookaside.missing_entries(session, self.lookaside_cgi, package,
+                                                       entries, self.download_workers)
+            missing = set(entry.file for entry in entries)
+            for entry in sourcesf.entries:
+                if entry.file not in missing:
+                    self.log.info('%s is already in the lookaside cache', entry.file)
+            if not entries:
+                return
+
+        sources = []
+        for entry in entries:
+            urls = rcppkg_lookaside.find_source_urls(session, fedora_package_url, entry,
+                                                     self.download_workers)
+            if not urls:
+                raise rpkgError('%s was not found in the Fedora lookaside cache' % entry.file)
+            sources.append((entry, urls))
+
+        if native:
+            # Files go straight from the Fedora lookaside to ours
+            uploads = [(entry, urls[0]) for entry, urls in sources]
+            failed = [(entry, error) for entry, error
+                      in rcppkg_lookaside.upload_all(session, self.lookaside_cgi, package,
+                                                     uploads, self.download_workers) if error]
+            for entry, error in failed:
+                self.log.error('Could not upload %s: %s', entry.file, error)
+            if failed:
+                raise rpkgError('Could not upload all sources to the lookaside cache')
+            for entry, url in uploads:
+                self.log.info('Uploaded %s', entry.file)
+            return
 
         work_dir = "/tmp/%s" % package
         if not os.path.exists(work_dir):
@@ -631,21 +1150,26 @@ class Commands(pyrpkg.Commands):
             self.log.info("Directory with work directory name %s already exists locally" % work_dir)
             exit(0)
 
-        sourcesf = self.get_source_entries()
-        tails = []
-
-        for entry in sourcesf.entries:
-            file = entry.file
-            source_url = "%s%s/" % (fedora_package_url, file)
-            rcppkg_utils.find_link_tails(tails, file, source_url)
+        downloads = []
+        for entry, urls in sources:
+            for url in urls:
+                source_path = rcppkg_lookaside.relative_path(fedora_package_url, url)
+                downloads.append(rcppkg_download.Download(
+                    url, os.path.join(work_dir, source_path), entry.hashtype, entry.hash))
+
+        for download in downloads:
+            if not os.path.exists(os.path.dirname(download.path)):
+                os.makedirs(os.path.dirname(download.path))
+        failed = [(download, error) for download, error
+                  in rcppkg_download.download_all(downloads, self.download_workers) if error]
+        for download, error in failed:
+            self.log.error('Could not download %s: %s', download.url, error)
+        if failed:
+            shutil.rmtree(work_dir)
+            raise rpkgError('Could not download all sources from the Fedora lookaside cache')
 
-        for tail in tails:
-            source_path = "".join(tail.split("/repo/pkgs/%s/" % package)[1:])
-            dir_tree = "%s/%s" % (work_dir, "/".join(source_path.split('/')[:-1]))
-
-            os.makedirs(dir_tree)
-            os.system("wget %s -P %s" % (tail, dir_tree))
-
-        os.system("scp -r %s %s" % (work_dir, self.lookaside_cgi))
-        shutil.rmtree(work_dir)
+        try:
+            self.run_process(['scp', '-r', work_dir, self.lookaside_cgi])
+        finally:
+            shutil.rmtree(work_dir)
         
\ No newline at end of file
@@ -8,17 +8,28 @@ else:
     from six.moves.configparser import SafeConfigParser as ConfigParser
 
 import rcppkg
+import rcppkg.timing as rcppkg_timing
 import pyrpkg
 
 
-cli_name = os.path.basename(sys.argv[0])
+def main(config=None):
+    cli_name = os.path.basename(sys.argv[0])
 
+    # The daemon passes the config it has already read
+    if config is None:
+        config = ConfigParser()
+        config.read('/etc/rpkg/%s.conf' % cli_name)
 
-def main():
-    config = ConfigParser()
-    config.read('/etc/rpkg/%s.conf' % cli_name)
-    
     client = rcppkg.cli.rcppkgClient(config, name=cli_name)
+
+    # Reject commands that haven't been tested/modified to work, their
+    # subparsers aren't even registered
+    command = client.command_name
+    if command and command != 'help' and command not in rcppkg.cli.SUPPORTED_COMMANDS:
+        print("This command is not supported yet. Use one of the following:")
+        print(list(rcppkg.cli.SUPPORTED_COMMANDS))
+        sys.exit(0)
+
     client.do_imports(site='rcppkg')
     client.parse_cmdline()
 
@@ -32,10 +43,19 @@ def main():
     client.setupLogging(log)
     log.setLevel(logging.DEBUG)
 
+    if client.args.profile or client.args.profile_trace:
+        rcppkg_timing.enable()
+
     try:
-        sys.exit(client.args.command())
+        with rcppkg_timing.span('total'):
+            sys.exit(client.args.command())
     except KeyboardInterrupt:
         pass
+    finally:
+        if client.args.profile:
+            rcppkg_timing.report()
+        if client.args.profile_trace:
+            rcppkg_timing.write_trace(client.args.profile_trace)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+import time
+
+from pyrpkg.errors import rpkgError
+from rcppkg.kojiwatch import FINISHED_STATES, TASK_CLOSED, get_task_infos
+
+
+class DependencyCycleError(rpkgError):
+    pass
+
+
+def build_graph(dependencies):
+    """Map every package to the set of packages it needs to be built first
+
+    dependencies maps package names to their rcppkg.spec.SpecDependencies.
+    Requirements provided by packages outside the chain are ignored.
+    """
+    providers = {}
+    for package, deps in dependencies.items():
+        for provide in deps.provides:
+            providers[provide] = package
+
+    graph = {}
+    for package, deps in dependencies.items():
+        graph[package] = set(providers[requirement] for requirement in deps.build_requires
+                             if providers.get(requirement, package) != package)
+    return graph
+
+
+def find_cycle(graph):
+    visiting = []
+    visited = set()
+
+    def visit(package):
+        if package in visiting:
+            return visiting[visiting.index(package):] + [package]
+        if package in visited:
+            return None
+        visiting.append(package)
+        for requirement in sorted(graph[package]):
+            cycle = visit(requirement)
+            if cycle:
+                return cycle
+        visiting.pop()
+        visited.add(package)
+        return None
+
+    for package in sorted(graph):
+        cycle = visit(package)
+        if cycle:
+            return cycle
+    return None
+
+
+def build_layers(graph):
+    """Group packages into layers whose packages only need earlier layers"""
+    remaining = dict((package, set(requirements)) for package, requirements in graph.items())
+    layers = []
+    while remaining:
+        layer = sorted(package for package, requirements in remaining.items()
+                       if not requirements)
+        if not layer:
+            cycle = find_cycle(remaining)
+            raise DependencyCycleError('Dependency cycle between packages: %s'
+                                       % ' -> '.join(cycle))
+        for package in layer:
+            del remaining[package]
+        for requirements in remaining.values():
+            requirements.difference_update(layer)
+        layers.append(layer)
+    return layers
+
+
+class ChainScheduler(object):
+    """Build packages as soon as everything they need is available
+
+    A package is submitted once all packages it requires have been built
+    and have landed in a repo of the build tag. Packages depending on a
+    failed build are skipped, as are packages depending on one of the
+    packages in failed, which maps packages that could not be set up to
+    their (task_id, result).
+    """
+
+    def __init__(self, session, target, build_tag, graph, urls, opts=None,
+                 priority=None, max_parallel=0, poll_interval=20, log=None,
+                 failed=None):
+        self.session = session
+        self.target = target
+        self.build_tag = build_tag
+        self.graph = graph
+        self.urls = urls
+        self.opts = opts or {}
+        self.priority = priority
+        self.max_parallel = max_parallel
+        self.poll_interval = poll_interval
+        self.log = log
+
+        self.pending = set(graph)
+        self.running = {}
+        self.awaiting_repo = {}
+        self.available = set()
+        self.results = {}
+
+        for package, (task_id, result) in sorted((failed or {}).items()):
+            self.pending.discard(package)
+            self.fail(package, task_id, result)
+
+    def ready_packages(self):
+        ready = sorted(package for package in self.pending
+                       if self.graph[package] <= self.available)
+        if self.max_parallel:
+            ready = ready[:max(0, self.max_parallel - len(self.running))]
+        return ready
+
+    def submit(self, packages):
+        self.session.multicall = True
+        for package in packages:
+            self.session.build(self.urls[package], self.target, self.opts,
+                               priority=self.priority)
+        results = self.session.multiCall()
+
+        for package, result in zip(packages, results):
+            self.pending.discard(package)
+            if isinstance(result, dict):
+                self.log.error('Could not build %s: %s', package, result['faultString'])
+                self.fail(package, None)
+            else:
+                self.log.info('Building %s: task %s', package, result[0])
+                self.running[result[0]] = package
+
+    def fail(self, package, task_id, result='failed'):
+        self.results[package] = (task_id, result)
+        for dependent in sorted(self.pending):
+            if dependent in self.pending and package in self.graph[dependent]:
+                self.log.error('Skipping %s, it needs %s', dependent, package)
+                self.pending.discard(dependent)
+                self.fail(dependent, None, 'skipped')
+
+    def poll_tasks(self):
+        infos = get_task_infos(self.session, sorted(self.running))
+
+        finished = []
+        for task_id, info in sorted(infos.items()):
+            if info['state'] in FINISHED_STATES:
+                finished.append((task_id, info['state']))
+        if not finished:
+            return
+
+        event = self.session.getLastEvent()['id']
+        for task_id, state in finished:
+            package = self.running.pop(task_id)
+            if state == TASK_CLOSED:
+                self.log.info('%s built', package)
+                self.results[package] = (task_id, 'built')
+                self.awaiting_repo[package] = event
+            else:
+                self.log.error('%s failed to build, task %s', package, task_id)
+                self.fail(package, task_id)
+
+    def poll_repo(self):
+        # Waiting for a new repo can't be answered from a cache
+        session = getattr(self.session, 'uncached', self.session)
+        repo = session.getRepo(self.build_tag)
+        if not repo:
+            return
+        for package, event in list(self.awaiting_repo.items()):
+            if repo['create_event'] >= event:
+                del self.awaiting_repo[package]
+                self.available.add(package)
+
+    def run(self):
+        """Build all packages, returning {package: (task_id, result)}"""
+        while self.pending or self.running:
+            ready = self.ready_packages()
+            if ready:
+                self.submit(ready)
+            if not self.running and not self.awaiting_repo and not self.ready_packages():
+                break
+
+            time.sleep(self.poll_interval)
+            if self.running:
+                self.poll_tasks()
+            if self.awaiting_repo and self.pending:
+                self.poll_repo()
+
+        return self.results
@@ -1,13 +1,84 @@
+import argparse
+import collections
 import os
+import sys
+import time
+
+from six.moves import configparser
+
+import rcppkg.utils as rcppkg_utils
 
 from pyrpkg.cli import cliClient
 from pyrpkg.errors import rpkgError
 
+
+# Commands that have been tested/modified to work, mapped to the methods
+# registering their subparsers
+SUPPORTED_COMMANDS = collections.OrderedDict([
+    ('build', 'register_build'),
+    ('build-many', 'register_build_many'),
+    ('chain-build', 'register_chainbuild'),
+    ('clone', 'register_clone'),
+    ('container-build', 'register_container_build'),
+    ('mockbuild', 'register_mockbuild'),
+    ('new-sources', 'register_new_sources'),
+    ('search', 'register_search'),
+    ('cache-stats', 'register_cache_stats'),
+    ('cache-prune', 'register_cache_prune'),
+    ('prefetch', 'register_prefetch'),
+])
+
+
+class GlobalOptionsParser(argparse.ArgumentParser):
+    """Parser of the global options alone, leaving the command to the caller"""
+
+    def error(self, message):
+        raise ValueError(message)
+
+
 class rcppkgClient(cliClient):
     def __init__(self, config, name=None):
         self.DEFAULT_CLI_NAME = 'rcppkg'
         super(rcppkgClient, self).__init__(config, name)
 
+    def setup_argparser(self):
+        super(rcppkgClient, self).setup_argparser()
+
+        self.parser.add_argument('--no-cache', action='store_true', default=False,
+                                 help='Do not use cached build system metadata')
+        self.parser.add_argument('--profile', action='store_true', default=False,
+                                 help='Print the time spent in each phase of the command')
+        self.parser.add_argument('--profile-trace', default=None, metavar='FILE',
+                                 help='Write the phases of the command to FILE in Chrome '
+                                      'trace format, see chrome://tracing')
+
+        self.command_name = self.find_command(sys.argv[1:])
+
+    def find_command(self, argv):
+        """Return the name of the command in argv, None if there is none
+
+        Only the global options are parsed here, the command is the first
+        argument they leave over.
+        """
+        parser = GlobalOptionsParser(add_help=False)
+        for action in self.parser._actions:
+            if not action.option_strings:
+                continue
+            if action.nargs == 0:
+                parser.add_argument(*action.option_strings, dest=action.dest,
+                                    action='store_true')
+            else:
+                parser.add_argument(*action.option_strings, dest=action.dest,
+                                    nargs=action.nargs)
+        try:
+            args, rest = parser.parse_known_args(argv)
+        except ValueError:
+            # The real parser reports the error
+            return None
+        if rest and not rest[0].startswith('-'):
+            return rest[0]
+        return None
+
     def setup_subparsers(self):
         """Setup basic subparsers that all clients should use"""
 
@@ -20,8 +91,17 @@ class rcppkgClient(cliClient):
         self.register_build_common()
         self.register_rpm_common()
 
+        # Only the subparser of the command being run is needed, the rest
+        # are registered for help output
+        command = self.command_name
+        if command not in (None, 'help'):
+            if command in SUPPORTED_COMMANDS:
+                getattr(self, SUPPORTED_COMMANDS[command])()
+            return
+
         # Other targets
         self.register_build()
+        self.register_build_many()
         self.register_chainbuild()
         self.register_clean()
         self.register_clog()
@@ -57,6 +137,9 @@ class rcppkgClient(cliClient):
         self.register_verify_files()
         self.register_verrel()
         self.register_search()
+        self.register_cache_stats()
+        self.register_cache_prune()
+        self.register_prefetch()
 
     def load_cmd(self):
         """This sets up the cmd object"""
@@ -97,7 +180,15 @@ class rcppkgClient(cliClient):
                                        target=target,
                                        quiet=self.args.q,
                                        distgit_namespaced=dg_namespaced,
-                                       realms=realms
+                                       realms=realms,
+                                       remote_check_ttl=int(items.get('remote_check_ttl',
+                                                                      rcppkg_utils.REMOTE_CHECK_TTL)),
+                                       offline=getattr(self.args, 'offline', False),
+                                       command=self.command_name,
+                                       gitlab_per_page=int(items.get('gitlab_per_page',
+                                                                     rcppkg_utils.GITLAB_PER_PAGE)),
+                                       gitlab_workers=int(items.get('gitlab_workers',
+                                                                    rcppkg_utils.GITLAB_WORKERS))
                                        )
 
         self._cmd.module_name = self.args.module_name
@@ -106,6 +197,23 @@ class rcppkgClient(cliClient):
         self._cmd.debug = self.args.debug
         self._cmd.verbose = self.args.v
         self._cmd.clone_config = items.get('clone_config')
+        self._cmd.download_workers = int(items.get('download_workers', 4))
+        self._cmd.use_cache = not self.args.no_cache
+        self._cmd.mock_slots = int(items.get('mock_slots', 2))
+        self._cmd.mock_build_cpus = int(items.get('mock_build_cpus', 2))
+        self._cmd.mock_build_memory = rcppkg_utils.parse_size(items.get('mock_build_memory', '4G'))
+        self._cmd.koji_cache_ttl = int(items.get('koji_cache_ttl', 300))
+        self._cmd.source_cache_dir = items.get('source_cache_dir')
+        self._cmd.source_cache_size = rcppkg_utils.parse_size(items.get('source_cache_size', '20G'))
+        self._cmd.compress_level = int(items['compress_level']) if items.get('compress_level') else None
+        self._cmd.compress_threads = int(items.get('compress_threads', 0))
+        try:
+            self._cmd.reproducible_tarball = self.config.getboolean(self.name,
+                                                                    "reproducible_tarball")
+        except ValueError:
+            raise rpkgError('reproducible_tarball option must be a boolean')
+        except configparser.NoOptionError:
+            self._cmd.reproducible_tarball = False
 
         if hasattr(self.args, 'version_hash'):
         	self._cmd.version_hash = self.args.version_hash
@@ -139,6 +247,93 @@ class rcppkgClient(cliClient):
             'version_hash', default=None, nargs='?', help='Hash of the spec file commit to be built.')
         build_parser.set_defaults(command=self.build)
 
+    def register_build_many(self):
+        """Register the build-many target"""
+
+        build_many_parser = self.subparsers.add_parser(
+            'build-many', help='Request builds of several packages',
+            parents=[self.build_parser_common],
+            description='This command requests builds of all given packages '
+                        'in the build system at once. Packages are given as '
+                        '<package> or <package>@<spec file commit hash>, by '
+                        'default the latest local spec file commit is built.')
+        build_many_parser.add_argument(
+            'packages', nargs='*', help='Packages to build')
+        build_many_parser.add_argument(
+            '--manifest', default=None,
+            help='File listing packages to build, one per line, optionally '
+                 'followed by a spec file commit hash')
+        build_many_parser.add_argument(
+            '--skip-tag', action='store_true', default=False,
+            help='Do not attempt to tag packages')
+        build_many_parser.add_argument(
+            '--scratch', action='store_true', default=False,
+            help='Perform scratch builds')
+        build_many_parser.add_argument(
+            '--fail-fast', action='store_true', default=False,
+            help='Stop watching as soon as one build fails')
+        build_many_parser.set_defaults(command=self.build_many)
+
+    def build_many(self):
+        packages = [rcppkg_utils.parse_package_spec(package) for package in self.args.packages]
+        if self.args.manifest:
+            packages.extend(rcppkg_utils.read_package_manifest(self.args.manifest))
+        if not packages:
+            raise rpkgError('No packages to build given')
+
+        submitted = self.cmd.build_many(packages, skip_tag=self.args.skip_tag,
+                                        scratch=self.args.scratch,
+                                        background=self.args.background)
+        task_ids = [task_id for package, task_id in submitted if task_id]
+        if len(task_ids) != len(submitted):
+            self.log.error('Some builds could not be submitted')
+        if not self.args.nowait:
+            labels = dict((task_id, package) for package, task_id in submitted)
+            if self._watch_koji_tasks(self.cmd.kojisession, task_ids, labels=labels):
+                return 1
+        return 0 if len(task_ids) == len(submitted) else 1
+
+    def register_chainbuild(self):
+        """Register the chain-build target"""
+
+        chain_build_parser = self.subparsers.add_parser(
+            'chain-build', help='Build packages in dependency order',
+            description='This command builds the given packages in the order '
+                        'required by the BuildRequires of their spec files. '
+                        'Packages that don\'t depend on each other are built '
+                        'in parallel and every package is started as soon as '
+                        'the packages it needs are available in the build tag.')
+        chain_build_parser.add_argument(
+            'packages', nargs='+', help='Packages to build')
+        chain_build_parser.add_argument(
+            '--target', default=None, help='Define build target to build into')
+        chain_build_parser.add_argument(
+            '--background', action='store_true', default=False,
+            help='Run the builds at a low priority')
+        chain_build_parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Only print the build plan')
+        chain_build_parser.add_argument(
+            '--max-parallel', type=int, default=0,
+            help='Maximum number of builds running at once, 0 for no limit')
+        chain_build_parser.set_defaults(command=self.chainbuild)
+
+    def chainbuild(self):
+        built = self.cmd.chain_build(self.args.packages, dry_run=self.args.dry_run,
+                                     background=self.args.background,
+                                     max_parallel=self.args.max_parallel)
+        return 0 if built else 1
+
+    def _watch_koji_tasks(self, session, tasklist, labels=None):
+        """Watch koji tasks until they finish, returning 0 if all succeeded"""
+
+        from rcppkg.kojiwatch import TaskWatcher
+
+        watcher = TaskWatcher(session, tasklist, labels=labels,
+                              fail_fast=getattr(self.args, 'fail_fast', False),
+                              weburl=self.cmd.kojiweburl)
+        return watcher.watch()
+
     def container_build_koji(self):
         target_override = False
         # Override the target if we were supplied one
@@ -194,7 +389,24 @@ class rcppkgClient(cliClient):
         self.cmd.upload(self.args.packages, replace=self.args.replace)
         self.log.info("Source upload succeeded.")
 
+    def register_mockbuild(self):
+        super(rcppkgClient, self).register_mockbuild()
+
+        self.subparsers.choices['mockbuild'].add_argument(
+            '--offline', action='store_true', default=False,
+            help='Build with the last mock config generated for the target '
+                 'without contacting Koji or the spec file repository')
+        self.subparsers.choices['mockbuild'].add_argument(
+            '--matrix', nargs='+', metavar='TARGET:ARCH[:DIST]', default=None,
+            type=rcppkg_utils.parse_matrix_combo,
+            help='Build for all of the given target, arch and optional dist '
+                 'combinations at once, results go to a directory per combination')
+
     def mockbuild(self):
+        if self.args.matrix and self.args.root:
+            self.subparsers.choices['mockbuild'].error(
+                'argument --root: not allowed with argument --matrix')
+
         mockargs = []
 
         if self.args.no_clean or self.args.no_clean_all:
@@ -209,6 +421,10 @@ class rcppkgClient(cliClient):
         except KeyError:
             # there were no args
             pass
+        if self.args.matrix:
+            if not self.cmd.mockbuild_matrix(self.args.matrix, mockargs, hashtype=self.args.hash):
+                return 1
+            return 0
         self.cmd.mockbuild(mockargs, self.args.root, hashtype=self.args.hash)
 
     def register_search(self):
@@ -216,8 +432,64 @@ class rcppkgClient(cliClient):
             'search', help='Search for packages',
             description='Search for available packages based on keyword given')
         self.search_parser.add_argument('search_word', nargs='?')
+        self.search_parser.add_argument(
+            '--refresh', action='store_true', default=False,
+            help='Relist all projects instead of using the local project index')
         self.search_parser.set_defaults(command=self.search)
 
     def search(self):
-        self.cmd.search_packages(self.args.search_word)
-
+        self.cmd.search_packages(self.args.search_word, refresh=self.args.refresh)
+
+
+    def register_cache_stats(self):
+        cache_stats_parser = self.subparsers.add_parser(
+            'cache-stats', help='Show source cache usage',
+            description='Show the number of files and disk space used by the '
+                        'source cache shared by all packages on this host')
+        cache_stats_parser.set_defaults(command=self.cache_stats)
+
+    def cache_stats(self):
+        self.cmd.source_cache_stats()
+
+    def register_cache_prune(self):
+        cache_prune_parser = self.subparsers.add_parser(
+            'cache-prune', help='Evict least recently used files from the source cache',
+            description='Remove least recently used files from the source cache '
+                        'until it fits the configured source_cache_size')
+        cache_prune_parser.add_argument(
+            '--max-size', default=None, type=rcppkg_utils.parse_size,
+            help='Size to shrink the cache to, e.g. 5G. Use 0 to empty it.')
+        cache_prune_parser.set_defaults(command=self.cache_prune)
+
+    def cache_prune(self):
+        self.cmd.prune_source_cache(self.args.max_size)
+
+    def register_prefetch(self):
+        prefetch_parser = self.subparsers.add_parser(
+            'prefetch', help='Fill the source cache with the sources of all local packages',
+            description='Download the files listed in the sources files of all '
+                        'packages in the build directory into the source cache, '
+                        'so later builds need not fetch them')
+        prefetch_parser.add_argument(
+            '--workers', default=None, type=int,
+            help='Number of concurrent downloads, download_workers by default')
+        prefetch_parser.add_argument(
+            '--max-rate', default=None, type=rcppkg_utils.parse_size,
+            help='Limit the combined download rate to this many bytes per second, e.g. 10M')
+        prefetch_parser.add_argument(
+            '--watch', action='store_true', default=False,
+            help='Keep running and prefetch again every --interval seconds')
+        prefetch_parser.add_argument(
+            '--interval', default=300, type=int,
+            help='Seconds between prefetches with --watch, defaults to 300')
+        prefetch_parser.set_defaults(command=self.prefetch)
+
+    def prefetch(self):
+        while True:
+            ok = self.cmd.prefetch(workers=self.args.workers, max_rate=self.args.max_rate)
+            if not self.args.watch:
+                return 0 if ok else 1
+            try:
+                time.sleep(self.args.interval)
+            except KeyboardInterrupt:
+                return 0
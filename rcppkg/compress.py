@@ -0,0 +1,164 @@
+import bz2
+import collections
+import gzip
+import io
+import multiprocessing
+import subprocess
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+# Size of the independently compressed blocks when compressing in-process
+BLOCK_SIZE = 4 * 1024 * 1024
+
+DEFAULT_LEVELS = {'gz': 6, 'bz2': 9, 'xz': 6}
+
+
+class ProcessWriter(object):
+    """File-like object feeding a compressor process writing to a file"""
+
+    def __init__(self, cmd, path):
+        self.cmd = cmd
+        self.out_file = open(path, 'wb')
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self.out_file)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        returncode = self.proc.wait()
+        self.out_file.close()
+        if returncode:
+            raise IOError('%s exited with %d' % (self.cmd[0], returncode))
+
+
+class BlockWriter(object):
+    """File-like object compressing fixed size blocks on a thread pool
+
+    gzip, bzip2 and xz all accept a file made of several concatenated
+    streams, so the blocks are compressed independently the same way pigz,
+    pbzip2 and pxz do it. zlib, bz2 and lzma release the GIL while
+    compressing, which lets the threads use all cores.
+    """
+
+    def __init__(self, path, compress_block, threads):
+        self.out_file = open(path, 'wb')
+        self.compress_block = compress_block
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= BLOCK_SIZE:
+            self.submit()
+
+    def submit(self):
+        block = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.pool.apply_async(self.compress_block, (block,)))
+        # Bound the memory held by blocks waiting to be written
+        while len(self.pending) > self.threads * 2:
+            self.out_file.write(self.pending.popleft().get())
+
+    def close(self):
+        try:
+            if self.buffered:
+                self.submit()
+            while self.pending:
+                self.out_file.write(self.pending.popleft().get())
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+            self.out_file.close()
+
+
+def gzip_block(level):
+    def compress(block):
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as f:
+            f.write(block)
+        return buf.getvalue()
+    return compress
+
+
+def parallel_tool_cmd(compression, level, threads):
+    if compression == 'gz' and which('pigz'):
+        return ['pigz', '-c', '-n', '-%d' % level, '-p', str(threads)]
+    elif compression == 'bz2' and which('pbzip2'):
+        return ['pbzip2', '-c', '-%d' % level, '-p%d' % threads]
+    elif compression == 'xz' and which('pxz'):
+        return ['pxz', '-c', '-%d' % level, '-T%d' % threads]
+    elif compression == 'xz' and which('xz'):
+        return ['xz', '-c', '-%d' % level, '-T%d' % threads]
+    return None
+
+
+def parallel_block_compressor(compression, level):
+    if compression == 'gz':
+        return gzip_block(level)
+    elif compression == 'bz2':
+        return lambda block: bz2.compress(block, level)
+    elif compression == 'xz' and lzma:
+        return lambda block: lzma.compress(block, preset=level)
+    return None
+
+
+def get_compression(file_extension):
+    if file_extension == '.tar.gz' or file_extension == '.tgz':
+        return 'gz'
+    elif file_extension == '.tar.bz2':
+        return 'bz2'
+    elif file_extension == '.tar.xz':
+        return 'xz'
+    return None
+
+
+def open_compressed(path, file_extension, level=None, threads=None, reproducible=False):
+    """Open path for writing, compressed according to file_extension
+
+    Up to threads cores are used, all of them if threads is not given. An
+    external pigz/pbzip2/pxz is preferred and the blocks are compressed
+    in-process when it is not installed. Reproducible output is always
+    compressed in-process in blocks, as the tools and the single stream
+    fallback each produce different bytes.
+    """
+    compression = get_compression(file_extension)
+    if compression is None:
+        return open(path, 'wb')
+
+    if level is None:
+        level = DEFAULT_LEVELS[compression]
+    if not threads:
+        threads = multiprocessing.cpu_count()
+
+    if threads > 1 or reproducible:
+        cmd = None if reproducible else parallel_tool_cmd(compression, level, threads)
+        if cmd:
+            return ProcessWriter(cmd, path)
+        compress_block = parallel_block_compressor(compression, level)
+        if compress_block:
+            return BlockWriter(path, compress_block, threads)
+
+    if compression == 'gz':
+        return gzip.GzipFile(path, 'wb', compresslevel=level, mtime=0)
+    elif compression == 'bz2':
+        return bz2.BZ2File(path, 'wb', compresslevel=level)
+    elif lzma:
+        return lzma.LZMAFile(path, 'wb', preset=level)
+    return ProcessWriter(['xz', '-c', '-%d' % level], path)
@@ -0,0 +1,272 @@
+"""Serve rcppkg commands from a process that has everything imported already
+
+The daemon listens on a Unix socket and runs the commands in its own
+process, one at a time, so that parsed spec files, the GitLab client and
+its connections, Koji logins and Koji metadata stay warm between them. The
+client (bin/rcppkg) holds an exclusive lock on <socket>.lock while it is
+served and runs the command itself when another client holds it.
+
+The client connects and sends, with its stdin, stdout and stderr passed
+along as SCM_RIGHTS file descriptors, one length prefixed JSON request:
+
+    {"argv": [...], "cwd": "...", "env": {...}, "config": "..."}
+
+config is the configuration file the client would have read. The daemon
+replies with newline separated JSON messages, {"pid": <pid>} when the
+command starts, so that the client can forward SIGINT to it, and
+{"exit": <status>} when the command is done.
+"""
+import argparse
+import array
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+
+import rcppkg.timing as rcppkg_timing
+import rcppkg.utils as rcppkg_utils
+
+
+SOCKET_PATH = os.path.join(rcppkg_utils.CACHE_DIR, 'daemon.sock')
+# Anything slow to import that commands are likely to need
+WARM_MODULES = ('koji', 'git', 'gitlab', 'requests', 'rcppkg.__main__', 'rcppkg.chain',
+                'rcppkg.download', 'rcppkg.kojicache', 'rcppkg.kojiwatch',
+                'rcppkg.lookaside', 'rcppkg.mockpool')
+MAX_REQUEST_SIZE = 1024 * 1024
+
+# Session info of Koji sessions logged in by earlier commands
+koji_sessions = {}
+# {path: (mtime, config)} of the configuration files clients asked for
+configs = {}
+
+log = logging.getLogger('rcppkg.daemon')
+
+
+class Shutdown(BaseException):
+    """Raised by SIGTERM, also while a command is running"""
+
+
+def reuse_koji_session(session, server):
+    """Give session the login of an earlier command, returning True on success"""
+    sinfo = koji_sessions.get(server)
+    if not sinfo:
+        return False
+    session.setSession(sinfo)
+    try:
+        if session.getLoggedInUser():
+            return True
+    except Exception:
+        pass
+    session.setSession(None)
+    return False
+
+
+def remember_koji_session(session, server):
+    """Keep the login of session for later commands"""
+    sinfo = getattr(session, 'sinfo', None)
+    if sinfo:
+        koji_sessions[server] = sinfo
+
+
+def recv_request(conn):
+    fds = array.array('i')
+    header, ancdata, flags, addr = conn.recvmsg(4, socket.CMSG_LEN(3 * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    if len(header) != 4 or len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        raise ValueError('Malformed request')
+
+    size = struct.unpack('!I', header)[0]
+    body = b''
+    try:
+        if size > MAX_REQUEST_SIZE:
+            raise ValueError('Request too large')
+        while len(body) < size:
+            chunk = conn.recv(size - len(body))
+            if not chunk:
+                raise ValueError('Truncated request')
+            body += chunk
+        return json.loads(body.decode('utf-8')), list(fds)
+    except Exception:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+def send_message(conn, message):
+    conn.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+def load_config(path):
+    from six.moves import configparser
+
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    if path not in configs or configs[path][0] != mtime:
+        config = configparser.ConfigParser()
+        config.read(path)
+        configs[path] = (mtime, config)
+    return configs[path][1]
+
+
+def all_loggers():
+    loggers = [logging.getLogger()]
+    loggers.extend(logger for logger in logging.Logger.manager.loggerDict.values()
+                   if isinstance(logger, logging.Logger))
+    return loggers
+
+
+def save_loggers():
+    # Commands add handlers and set levels, e.g. in setupLogging
+    return dict((logger, (list(logger.handlers), logger.level)) for logger in all_loggers())
+
+
+def restore_loggers(saved):
+    for logger in all_loggers():
+        handlers, level = saved.get(logger, ([], logging.NOTSET))
+        logger.handlers[:] = handlers
+        logger.setLevel(level)
+
+
+def run_command(conn, request, fds):
+    """Run one request in this process, returning its exit status
+
+    The process wide state a command changes, its standard streams, working
+    directory, environment, argv and logging, is put back afterwards.
+    """
+    saved_fds = [os.dup(fd) for fd in range(3)]
+    saved = (os.getcwd(), dict(os.environ), sys.argv, sys.stdin, sys.stdout, sys.stderr)
+    saved_loggers = save_loggers()
+    status = 1
+    try:
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        # New file objects so that buffering follows the client's terminal
+        sys.stdin = os.fdopen(0, 'r', closefd=False)
+        sys.stdout = os.fdopen(1, 'w', 1 if os.isatty(1) else -1, closefd=False)
+        sys.stderr = os.fdopen(2, 'w', 1, closefd=False)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        sys.argv = request['argv']
+        config = load_config(request['config'])
+
+        import rcppkg.__main__
+        send_message(conn, {'pid': os.getpid()})
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            rcppkg.__main__.main(config)
+            status = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                sys.stderr.write('%s\n' % e.code)
+        except KeyboardInterrupt:
+            pass
+    except Exception:
+        import traceback
+        traceback.print_exc()
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        cwd, environ, sys.argv, sys.stdin, sys.stdout, sys.stderr = saved
+        for target, fd in enumerate(saved_fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        restore_loggers(saved_loggers)
+        rcppkg_timing.reset()
+    return status
+
+
+def serve_connection(conn):
+    try:
+        request, fds = recv_request(conn)
+    except (ValueError, socket.error) as e:
+        log.warning('Dropping request: %s', e)
+        return
+    status = run_command(conn, request, fds)
+    try:
+        send_message(conn, {'exit': status})
+    except socket.error:
+        # The client went away, there is no one to tell
+        pass
+
+
+def shutdown(signum, frame):
+    raise Shutdown()
+
+
+def serve(socket_path=SOCKET_PATH):
+    for module in WARM_MODULES:
+        try:
+            __import__(module)
+        except ImportError as e:
+            log.debug('Not preloading %s: %s', module, e)
+
+    if not os.path.exists(os.path.dirname(socket_path)):
+        os.makedirs(os.path.dirname(socket_path))
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+    # Interrupts are forwarded by the client of the running command
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, shutdown)
+    log.info('Listening on %s', socket_path)
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            try:
+                serve_connection(conn)
+            finally:
+                conn.close()
+    except Shutdown:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve rcppkg commands from a warm process')
+    parser.add_argument('--socket', default=os.environ.get('RCPPKG_SOCKET', SOCKET_PATH),
+                        help='Unix socket to listen on, defaults to %s' % SOCKET_PATH)
+    args = parser.parse_args()
+
+    if not hasattr(socket.socket, 'recvmsg'):
+        sys.exit('The rcppkg daemon needs Python 3')
+    # Not on the root logger, which would also print what the commands log
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    serve(args.socket)
+
+
+if __name__ == '__main__':
+    # Commands look the daemon up as rcppkg.daemon, so its state must live
+    # there rather than in __main__
+    import rcppkg.daemon
+    rcppkg.daemon.main()
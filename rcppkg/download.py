@@ -0,0 +1,220 @@
+import collections
+import errno
+import fcntl
+import hashlib
+import os
+import requests
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+
+import rcppkg.timing as rcppkg_timing
+
+
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 60
+
+Download = collections.namedtuple('Download', ['url', 'path', 'hashtype', 'hash'])
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadLocked(Exception):
+    """Another process is downloading the file"""
+
+
+class RateLimiter(object):
+    """Limit the combined throughput of all download threads to rate bytes/s"""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.lock = threading.Lock()
+        self.available_at = time.time()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.time()
+            wait = self.available_at - now
+            self.available_at = max(self.available_at, now) + amount / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_http_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def hash_file(hasher, path, length=None):
+    with open(path, 'rb') as f:
+        while length is None or length > 0:
+            chunk = f.read(CHUNK_SIZE if length is None else min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if length is not None:
+                length -= len(chunk)
+
+
+def expected_size(response, offset):
+    if response.status_code == 206:
+        content_range = response.headers.get('Content-Range', '')
+        total = content_range.rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit() and 'Content-Encoding' not in response.headers:
+        return int(length)
+    return None
+
+
+def open_part(part_path, wait=True):
+    """Open and lock the partial download at part_path
+
+    A part file may be removed by the process holding its lock, so the
+    lock is only kept once it is known to be on the file at part_path.
+    """
+    while True:
+        f = os.fdopen(os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(part_path)):
+                return f
+        except (IOError, OSError) as e:
+            f.close()
+            if e.errno == errno.ENOENT:
+                # Removed by the process that held the lock
+                continue
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            raise DownloadLocked('%s is being downloaded by another process'
+                                 % part_path[:-len('.part')])
+        f.close()
+
+
+def download_file(session, download, limiter=None, wait=True):
+    # Partial downloads are kept next to the target so they can be resumed.
+    # They are locked while written, so a process only ever resumes its own
+    # data or data left behind by a process that has gone away.
+    part_path = '%s.part' % download.path
+    with open_part(part_path, wait) as f:
+        if os.path.exists(download.path):
+            # Another process completed the download while we waited
+            os.remove(part_path)
+            return
+        try:
+            write_part(session, download, f, part_path, limiter)
+        except DownloadError:
+            # Oversized or corrupted partial data must not be resumed
+            os.remove(part_path)
+            raise
+        except Exception:
+            if not os.fstat(f.fileno()).st_size:
+                os.remove(part_path)
+            raise
+        os.rename(part_path, download.path)
+
+
+def write_part(session, download, f, part_path, limiter=None):
+    offset = os.fstat(f.fileno()).st_size
+
+    hasher = hashlib.new(download.hashtype)
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+
+    response = session.get(download.url, headers=headers, stream=True, timeout=TIMEOUT)
+    try:
+        if offset and response.status_code == 416:
+            # The partial file may already hold everything the server has
+            hash_file(hasher, part_path)
+        else:
+            response.raise_for_status()
+            if response.status_code == 206:
+                if not response.headers.get('Content-Range', '').startswith('bytes %d-' % offset):
+                    raise DownloadError('unexpected Content-Range %s'
+                                        % response.headers.get('Content-Range'))
+                hash_file(hasher, part_path, offset)
+            else:
+                # Server ignored the range request and sends the whole file
+                offset = 0
+            size = expected_size(response, offset)
+
+            f.truncate(offset)
+            f.seek(offset)
+            written = offset
+            try:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    written += len(chunk)
+                    if size is not None and written > size:
+                        raise DownloadError('received more than the announced %d bytes' % size)
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    rcppkg_timing.count('bytes downloaded', len(chunk))
+                    if limiter:
+                        limiter.consume(len(chunk))
+            finally:
+                f.flush()
+            if size is not None and written != size:
+                # Not fatal, the next attempt resumes from what was received
+                raise IOError('received %d of %d bytes' % (written, size))
+    finally:
+        response.close()
+
+    if hasher.hexdigest() != download.hash.strip().lower():
+        raise DownloadError('%s checksum mismatch' % download.hashtype)
+
+
+def fetch(session, download, retries, backoff, limiter=None, wait=True):
+    if download.hashtype not in hashlib.algorithms_available:
+        return DownloadError('unsupported hashtype %s' % download.hashtype)
+
+    error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            with rcppkg_timing.span('download', url=download.url):
+                download_file(session, download, limiter, wait)
+            return None
+        except DownloadLocked as e:
+            return e
+        except (requests.RequestException, IOError, OSError, DownloadError) as e:
+            error = e
+
+    return error
+
+
+def download_all(downloads, workers=4, retries=3, backoff=1, max_rate=None, wait=True):
+    """Download files concurrently, verifying their checksums on the fly
+
+    max_rate limits the combined download rate in bytes per second. Files
+    another process is downloading are waited for, unless wait is unset,
+    in which case they fail with DownloadLocked. Returns a list of
+    (download, error) tuples in the order given, error being None for
+    files that were downloaded successfully.
+    """
+    if not downloads:
+        return []
+
+    workers = max(1, min(workers, len(downloads)))
+    limiter = RateLimiter(max_rate) if max_rate else None
+    session = get_http_session(workers)
+    pool = ThreadPool(workers)
+    try:
+        errors = pool.map(lambda download: fetch(session, download, retries, backoff,
+                                                 limiter, wait),
+                          downloads)
+    finally:
+        pool.close()
+        pool.join()
+        session.close()
+
+    return list(zip(downloads, errors))
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import time
+
+import rcppkg.utils as rcppkg_utils
+
+
+# Read-only hub calls worth memoizing
+CACHED_METHODS = ('getBuildTarget', 'getTag', 'getFullInheritance', 'getRepo')
+# Calls after which a new repo of some tag is to be expected
+REPO_CHANGING_METHODS = ('build', 'chainBuild', 'buildContainer', 'tagBuild',
+                         'untagBuild', 'newRepo')
+
+KOJI_CACHE_TTL = 5 * 60
+REPO_CACHE_TTL = 60
+
+# In-memory entries per hub, shared by all sessions of the process
+_memory = {}
+
+
+class CachingKojiSession(object):
+    """Koji session wrapper memoizing read-only lookups
+
+    Results of CACHED_METHODS are kept for ttl seconds, on disk and in
+    memory, where they are shared with the other sessions to the same hub so
+    that they stay warm in a daemon. Repos change more often, so they are
+    only trusted for repo_ttl seconds after they were fetched, and are
+    dropped whenever a call that leads to a new repo goes through the
+    wrapper.
+    Everything else, including multicalls, is passed through to the wrapped
+    session, which stays available as uncached.
+    """
+
+    def __init__(self, session, server, ttl=KOJI_CACHE_TTL, repo_ttl=REPO_CACHE_TTL):
+        server_id = hashlib.sha1(server.encode('utf-8')).hexdigest()[:12]
+        object.__setattr__(self, 'uncached', session)
+        object.__setattr__(self, 'ttl', ttl)
+        object.__setattr__(self, 'repo_ttl', repo_ttl)
+        object.__setattr__(self, 'cache_path',
+                           os.path.join(rcppkg_utils.CACHE_DIR, 'koji-%s.json' % server_id))
+        object.__setattr__(self, 'entries', rcppkg_utils.read_json(self.cache_path) or {})
+        object.__setattr__(self, 'memory', _memory.setdefault(server_id, {}))
+
+    def __getattr__(self, name):
+        attr = getattr(self.uncached, name)
+        if name in CACHED_METHODS:
+            return lambda *args, **kwargs: self.cached_call(name, attr, args, kwargs)
+        if name in REPO_CHANGING_METHODS:
+            self.invalidate('getRepo')
+        return attr
+
+    def __setattr__(self, name, value):
+        # Flags like multicall belong to the wrapped session
+        setattr(self.uncached, name, value)
+
+    def cached_call(self, name, method, args, kwargs):
+        # Queued multicall requests have no result to remember yet
+        if self.uncached.multicall:
+            return method(*args, **kwargs)
+
+        key = json.dumps([name, args, sorted(kwargs.items())])
+        now = time.time()
+        ttl = self.repo_ttl if name == 'getRepo' else self.ttl
+        entry = self.memory.get(key)
+        if entry and now - entry['time'] < ttl:
+            return entry['value']
+        entry = self.entries.get(key)
+        if entry and now - entry['time'] < ttl:
+            self.memory[key] = entry
+            return entry['value']
+
+        entry = {'time': now, 'value': method(*args, **kwargs)}
+        self.memory[key] = self.entries[key] = entry
+        self.save()
+        return entry['value']
+
+    def invalidate(self, method=None):
+        for entries in (self.memory, self.entries):
+            for key in list(entries):
+                if method is None or json.loads(key)[0] == method:
+                    del entries[key]
+        self.save()
+
+    def save(self):
+        now = time.time()
+        entries = dict((key, entry) for key, entry in self.entries.items()
+                       if now - entry['time'] < self.ttl)
+        try:
+            rcppkg_utils.write_json_atomic(self.cache_path, entries)
+        except (IOError, OSError, TypeError, ValueError):
+            # The in-memory cache still works without a writable disk cache
+            pass
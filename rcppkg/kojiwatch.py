@@ -0,0 +1,141 @@
+import sys
+import time
+
+
+# Koji task states, see koji.TASK_STATES
+TASK_STATES = {0: 'free', 1: 'open', 2: 'closed', 3: 'canceled', 4: 'assigned', 5: 'failed'}
+TASK_CLOSED = 2
+TASK_CANCELED = 3
+TASK_FAILED = 5
+FINISHED_STATES = (TASK_CLOSED, TASK_CANCELED, TASK_FAILED)
+
+
+def get_task_infos(session, task_ids, children=False):
+    """Fetch task infos, and optionally their children, in one multicall
+
+    Returns {task_id: info}, with the child task infos stored as a list
+    under the 'children' key of each info when requested. Deleted and
+    unknown tasks are reported as failed.
+    """
+    if not task_ids:
+        return {}
+
+    session.multicall = True
+    for task_id in task_ids:
+        session.getTaskInfo(task_id)
+        if children:
+            session.getTaskChildren(task_id)
+    results = session.multiCall(strict=True)
+
+    infos = {}
+    step = 2 if children else 1
+    for i, task_id in enumerate(task_ids):
+        info = results[i * step][0]
+        if info is None:
+            info = {'id': task_id, 'state': TASK_FAILED, 'method': 'unknown task'}
+        if children:
+            info['children'] = results[i * step + 1][0] or []
+        infos[task_id] = info
+    return infos
+
+
+class TaskWatcher(object):
+    """Watch many Koji tasks with a few batched requests
+
+    All unfinished tasks and their children are polled in a single
+    multicall. The poll interval starts at min_interval, grows while
+    nothing changes and drops back as soon as a task changes state.
+    """
+
+    def __init__(self, session, task_ids, labels=None, fail_fast=False,
+                 min_interval=2, max_interval=30, out=None, weburl=None):
+        self.session = session
+        self.task_ids = list(task_ids)
+        self.labels = labels or {}
+        self.fail_fast = fail_fast
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.out = out or sys.stdout
+        self.weburl = weburl
+        self.infos = {}
+        self.drawn_lines = 0
+
+    def unfinished(self):
+        return [task_id for task_id in self.task_ids
+                if self.infos.get(task_id, {}).get('state') not in FINISHED_STATES]
+
+    def failed(self):
+        return [task_id for task_id in self.task_ids
+                if self.infos.get(task_id, {}).get('state') in (TASK_CANCELED, TASK_FAILED)]
+
+    def poll(self):
+        """Refresh unfinished tasks, returning True if anything changed"""
+        infos = get_task_infos(self.session, self.unfinished(), children=True)
+        changed = False
+        for task_id, info in infos.items():
+            if self.status(info) != self.status(self.infos.get(task_id)):
+                changed = True
+            self.infos[task_id] = info
+        return changed
+
+    def status(self, info):
+        if info is None:
+            return None
+        children = info.get('children', [])
+        counts = {}
+        for child in children:
+            state = TASK_STATES.get(child['state'], child['state'])
+            counts[state] = counts.get(state, 0) + 1
+        return (info['state'], tuple(sorted(counts.items())))
+
+    def format_line(self, task_id):
+        info = self.infos.get(task_id)
+        if info is None:
+            return '%-10s %-30s %s' % (task_id, self.labels.get(task_id, ''), 'unknown')
+        state, counts = self.status(info)
+        label = self.labels.get(task_id) or info.get('method', '')
+        children = ', '.join('%d %s' % (count, name) for name, count in counts)
+        return '%-10s %-30s %-9s %s' % (task_id, label, TASK_STATES.get(state, state),
+                                        children and '(%s)' % children)
+
+    def draw(self):
+        lines = [self.format_line(task_id) for task_id in self.task_ids]
+        if self.out.isatty():
+            # Redraw the table in place
+            if self.drawn_lines:
+                self.out.write('\x1b[%dA' % self.drawn_lines)
+            self.out.write(''.join('\x1b[K%s\n' % line for line in lines))
+            self.drawn_lines = len(lines)
+        else:
+            self.out.write(''.join('%s\n' % line for line in lines) + '\n')
+        self.out.flush()
+
+    def watch(self):
+        """Watch until all tasks finish, returning 0 if all of them succeeded"""
+        if not self.task_ids:
+            return 0
+
+        interval = self.min_interval
+        try:
+            while True:
+                if self.poll():
+                    interval = self.min_interval
+                    self.draw()
+                else:
+                    interval = min(interval * 1.5, self.max_interval)
+
+                if self.fail_fast and self.failed():
+                    break
+                if not self.unfinished():
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            self.out.write('Tasks still running. You can continue to watch with the '
+                           "'koji watch-task' command.\n")
+            raise
+
+        failed = self.failed()
+        for task_id in failed:
+            url = '%s/taskinfo?taskID=%s' % (self.weburl, task_id) if self.weburl else ''
+            self.out.write('Task %s failed %s\n' % (task_id, url))
+        return 1 if failed or self.unfinished() else 0
@@ -0,0 +1,230 @@
+import hashlib
+import logging
+import posixpath
+import requests
+import uuid
+
+from multiprocessing.pool import ThreadPool
+
+import rcppkg.download as rcppkg_download
+import rcppkg.timing as rcppkg_timing
+import rcppkg.utils as rcppkg_utils
+
+
+FEDORA_LOOKASIDE_URL = "http://pkgs.fedoraproject.org/repo/pkgs"
+
+# <file>/<hashtype>/<hash>/<file> is as deep as the lookaside goes
+MAX_CRAWL_DEPTH = 4
+
+log = logging.getLogger('rcppkg.lookaside')
+
+
+def source_paths(entry):
+    """Paths of a sources file entry relative to the package's directory"""
+    paths = ['%s/%s/%s/%s' % (entry.file, entry.hashtype, entry.hash, entry.file)]
+    if entry.hashtype == 'md5':
+        # Old layout without the hash type
+        paths.append('%s/%s/%s' % (entry.file, entry.hash, entry.file))
+    return paths
+
+
+def index_links(text):
+    """Entries of an index page, without its parent and sorting links"""
+    parser = rcppkg_utils.link_html_parser()
+    parser.feed(text)
+    start = rcppkg_utils.find_files_start(parser.links)
+    links = parser.links[start:] if start >= 0 else parser.links
+    return [link for link in links
+            if link and not link.startswith(('?', '/', '#')) and '://' not in link]
+
+
+def fetch_index(session, url):
+    """The response for the index page at url, None if it can't be fetched"""
+    try:
+        return session.get(url, timeout=rcppkg_download.TIMEOUT)
+    except requests.RequestException as e:
+        log.debug('Skipping %s: %s', url, e)
+        return None
+
+
+def crawl(session, url, file_name, workers=4):
+    """Find the URLs of file_name below the index page at url
+
+    The index pages are walked breadth first, one level at a time with up
+    to workers pages fetched at once. Every page is fetched only once and
+    pages that can't be fetched are skipped.
+    """
+    found = []
+    visited = set([url])
+    level = [url]
+    pool = ThreadPool(workers)
+    try:
+        for _ in range(MAX_CRAWL_DEPTH):
+            if not level:
+                break
+            pages = pool.map(lambda page_url: (page_url, fetch_index(session, page_url)), level)
+
+            level = []
+            for page_url, response in pages:
+                if response is None or response.status_code != 200:
+                    continue
+                for link in index_links(response.text):
+                    link_url = page_url + link
+                    if link_url in visited:
+                        continue
+                    visited.add(link_url)
+                    if link == file_name:
+                        found.append(link_url)
+                    elif link.endswith('/'):
+                        level.append(link_url)
+    finally:
+        pool.close()
+        pool.join()
+    return found
+
+
+def find_source_urls(session, package_url, entry, workers=4):
+    """Find the lookaside URLs of a sources file entry
+
+    The known locations of the file are tried first and the package's
+    index pages are only crawled when the file is in none of them.
+    """
+    for path in source_paths(entry):
+        url = package_url + path
+        try:
+            response = session.head(url, allow_redirects=True, timeout=rcppkg_download.TIMEOUT)
+        except requests.RequestException as e:
+            log.debug('Skipping %s: %s', url, e)
+            continue
+        if response.status_code == 200:
+            return [url]
+
+    return crawl(session, '%s%s/' % (package_url, entry.file), entry.file, workers)
+
+
+def relative_path(package_url, url):
+    return posixpath.normpath(url[len(package_url):])
+
+
+class UploadError(Exception):
+    pass
+
+
+class StreamBody(object):
+    """Request body of known length produced by an iterator
+
+    requests sends iterables with chunked encoding unless they have a length,
+    which the upload CGI needs.
+    """
+
+    def __init__(self, chunks, length):
+        self.chunks = chunks
+        self.length = length
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __len__(self):
+        return self.length
+
+
+def hash_field(entry):
+    return '%ssum' % entry.hashtype
+
+
+def is_uploaded(session, cgi_url, package, entry):
+    data = {'name': package, 'filename': entry.file, hash_field(entry): entry.hash}
+    response = session.post(cgi_url, data=data, timeout=rcppkg_download.TIMEOUT)
+    if response.status_code != 200:
+        raise UploadError('Checking for %s failed with HTTP %d' % (entry.file, response.status_code))
+    return response.text.strip() == 'Available'
+
+
+def missing_entries(session, cgi_url, package, entries, workers=4):
+    """Sources file entries the lookaside doesn't have yet
+
+    The upload CGI only answers for one file per request, so the entries
+    are checked in parallel.
+    """
+    if not entries:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(entries))))
+    try:
+        uploaded = pool.map(lambda entry: is_uploaded(session, cgi_url, package, entry), entries)
+    finally:
+        pool.close()
+        pool.join()
+    return [entry for entry, present in zip(entries, uploaded) if not present]
+
+
+def upload_stream(session, cgi_url, package, entry, source_url):
+    """Pass the file at source_url on to the upload CGI without storing it
+
+    The file is sent as multipart form data like rpkg does, checksummed
+    on the way through. The request is aborted before the form is complete
+    if the file doesn't match its checksum, so the CGI never stores it.
+    """
+    source = session.get(source_url, stream=True, timeout=rcppkg_download.TIMEOUT)
+    if source.status_code != 200:
+        raise UploadError('Fetching %s failed with HTTP %d' % (source_url, source.status_code))
+
+    boundary = uuid.uuid4().hex
+    head = ''.join('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                   % (boundary, name, value)
+                   for name, value in (('name', package), ('filename', entry.file),
+                                       (hash_field(entry), entry.hash)))
+    head += ('--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\n'
+             'Content-Type: application/octet-stream\r\n\r\n' % (boundary, entry.file))
+    head = head.encode('utf-8')
+    tail = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+    hasher = hashlib.new(entry.hashtype)
+
+    def chunks():
+        yield head
+        for chunk in source.iter_content(rcppkg_download.CHUNK_SIZE):
+            hasher.update(chunk)
+            rcppkg_timing.count('bytes uploaded', len(chunk))
+            yield chunk
+        if hasher.hexdigest() != entry.hash.lower():
+            raise UploadError('%s from %s does not match its %s checksum'
+                              % (entry.file, source_url, entry.hashtype))
+        yield tail
+
+    size = rcppkg_download.expected_size(source, 0)
+    body = StreamBody(chunks(), len(head) + size + len(tail)) if size is not None else chunks()
+    try:
+        with rcppkg_timing.span('upload', file=entry.file):
+            response = session.post(cgi_url, data=body, timeout=rcppkg_download.TIMEOUT,
+                                    headers={'Content-Type': 'multipart/form-data; boundary=%s'
+                                                             % boundary})
+    finally:
+        source.close()
+    if response.status_code != 200:
+        raise UploadError('Uploading %s failed with HTTP %d: %s'
+                          % (entry.file, response.status_code, response.text.strip()))
+
+
+def upload_all(session, cgi_url, package, uploads, workers=4):
+    """Stream (entry, source_url) pairs to the upload CGI concurrently
+
+    Returns a list of (entry, error) tuples in the order given, error being
+    None for files that were uploaded successfully.
+    """
+    if not uploads:
+        return []
+
+    def upload(item):
+        entry, source_url = item
+        try:
+            upload_stream(session, cgi_url, package, entry, source_url)
+        except (UploadError, requests.RequestException) as e:
+            return e
+        return None
+
+    pool = ThreadPool(max(1, min(workers, len(uploads))))
+    try:
+        errors = pool.map(upload, uploads)
+    finally:
+        pool.close()
+        pool.join()
+    return [(entry, error) for (entry, source_url), error in zip(uploads, errors)]
@@ -0,0 +1,167 @@
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import time
+
+from contextlib import contextmanager
+
+import rcppkg.process as rcppkg_process
+import rcppkg.utils as rcppkg_utils
+
+
+# Appended to every pooled config. The chroot of a slot is kept between
+# builds, the root cache and the package cache are shared by all slots of
+# the same config.
+POOL_CONFIG_OPTS = """
+config_opts['root'] = %(root)r
+config_opts['plugin_conf']['root_cache_enable'] = True
+config_opts['plugin_conf']['yum_cache_enable'] = True
+config_opts['plugin_conf']['dnf_cache_enable'] = True
+config_opts['cleanup_on_success'] = False
+config_opts['cleanup_on_failure'] = False
+"""
+
+
+class ChrootSlot(object):
+    def __init__(self, config_path, name, ready_path):
+        self.config_path = config_path
+        self.name = name
+        self.ready_path = ready_path
+
+    @property
+    def ready(self):
+        """Whether the chroot of the slot was set up by an earlier build"""
+        return os.path.exists(self.ready_path)
+
+    def mock_args(self):
+        args = ['-r', self.config_path, '--uniqueext', self.name]
+        if self.ready:
+            args.append('--no-clean')
+        return args
+
+    def mark_ready(self):
+        open(self.ready_path, 'w').close()
+
+
+class ChrootPool(object):
+    """Mock chroots kept between builds, keyed by the mock config
+
+    Every distinct config gets a directory named after its hash holding the
+    config and a lock file per slot. A build takes a free slot, which maps to
+    its own chroot through mock's --uniqueext, so as many builds of the
+    same config as there are slots can run at once. Configs no longer in
+    use are scrubbed once none of their slots are taken.
+    """
+
+    def __init__(self, root_dir, slots=2, log=None):
+        self.root_dir = root_dir
+        self.slots = max(1, slots)
+        self.log = log
+
+    def config_dir(self, config_hash):
+        return os.path.join(self.root_dir, config_hash)
+
+    def prepare(self, name, config):
+        """Store config in the pool, returning its hash
+
+        name identifies what the config is for, usually target-arch. The
+        previous config of the same name is evicted when it changes.
+        """
+        config_hash = hashlib.sha1(config.encode('utf-8')).hexdigest()[:12]
+        config_dir = self.config_dir(config_hash)
+        config_path = os.path.join(config_dir, 'mock.cfg')
+        if not os.path.exists(config_path):
+            rcppkg_utils.write_file_atomic(
+                config_path, config + POOL_CONFIG_OPTS % {'root': 'rcppkg-%s' % config_hash})
+
+        rcppkg_utils.write_file_atomic(os.path.join(self.root_dir, '%s.current' % name),
+                                       config_hash)
+        self.evict_stale()
+        return config_hash
+
+    def current_hashes(self):
+        hashes = set()
+        for entry in os.listdir(self.root_dir):
+            if entry.endswith('.current'):
+                with open(os.path.join(self.root_dir, entry)) as f:
+                    hashes.add(f.read().strip())
+        return hashes
+
+    def evict_stale(self):
+        current = self.current_hashes()
+        for config_hash in os.listdir(self.root_dir):
+            config_dir = self.config_dir(config_hash)
+            if config_hash in current or not os.path.isdir(config_dir):
+                continue
+            locks = self.try_lock_all(config_hash)
+            if locks is None:
+                # Still used by a running build, retried the next time
+                continue
+            try:
+                self.scrub(config_hash)
+            finally:
+                for lock in locks:
+                    lock.close()
+
+    def try_lock_all(self, config_hash):
+        locks = []
+        for slot in range(self.slots):
+            lock = self.try_lock(config_hash, slot)
+            if lock is None:
+                for taken in locks:
+                    taken.close()
+                return None
+            locks.append(lock)
+        return locks
+
+    def try_lock(self, config_hash, slot):
+        lock = open(os.path.join(self.config_dir(config_hash), 'slot%d.lock' % slot), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            lock.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return lock
+
+    def scrub(self, config_hash):
+        config_dir = self.config_dir(config_hash)
+        config_path = os.path.join(config_dir, 'mock.cfg')
+        if self.log:
+            self.log.info('Removing chroots of outdated mock config %s', config_hash)
+        if os.path.exists(config_path):
+            rcppkg_process.run_all([['mock', '-q', '-r', config_path, '--uniqueext',
+                                     'slot%d' % slot, '--scrub=chroot']
+                                    for slot in range(self.slots)
+                                    if os.path.exists(os.path.join(config_dir,
+                                                                   'slot%d.ready' % slot))],
+                                   self.slots)
+            rcppkg_process.run(['mock', '-q', '-r', config_path, '--scrub=all'], check=False)
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+    @contextmanager
+    def slot(self, config_hash, poll_interval=5):
+        """Take a free slot of the config, waiting for one if all are taken"""
+        config_dir = self.config_dir(config_hash)
+        waited = False
+        while True:
+            for slot in range(self.slots):
+                lock = self.try_lock(config_hash, slot)
+                if lock is not None:
+                    break
+            else:
+                if not waited and self.log:
+                    self.log.info('All %d chroots are busy, waiting for one', self.slots)
+                waited = True
+                time.sleep(poll_interval)
+                continue
+            break
+
+        try:
+            yield ChrootSlot(os.path.join(config_dir, 'mock.cfg'), 'slot%d' % slot,
+                             os.path.join(config_dir, 'slot%d.ready' % slot))
+        finally:
+            lock.close()
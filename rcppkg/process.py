@@ -0,0 +1,77 @@
+import collections
+import os
+import shlex
+import subprocess
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import rcppkg.timing as rcppkg_timing
+
+
+Result = collections.namedtuple('Result', ['argv', 'returncode', 'stdout', 'stderr', 'duration'])
+
+
+class ProcessError(Exception):
+    def __init__(self, result):
+        message = '%s exited with %d' % (' '.join(result.argv), result.returncode)
+        if result.stderr:
+            message += ': %s' % result.stderr.strip()
+        super(ProcessError, self).__init__(message)
+        self.result = result
+
+
+def split_options(options):
+    """Turn shell quoted option strings like "--define 'a b'" into argv items"""
+    argv = []
+    for option in options:
+        argv.extend(shlex.split(option))
+    return argv
+
+
+def run(argv, cwd=None, env=None, capture=True, stdout=None, stderr=None, check=True,
+        log=None):
+    """Run argv without a shell and return its Result
+
+    With capture the output is returned as text, otherwise it goes to
+    stdout and stderr, the caller's by default. Raises ProcessError on a
+    non-zero exit status when check is set.
+    """
+    if capture:
+        stdout = stderr = subprocess.PIPE
+    if log:
+        log.debug('Running %s', ' '.join(argv))
+
+    start = time.time()
+    with rcppkg_timing.span('run %s' % os.path.basename(argv[0])):
+        try:
+            proc = subprocess.Popen(argv, cwd=cwd, env=env, stdout=stdout, stderr=stderr,
+                                    universal_newlines=True)
+        except OSError as e:
+            raise ProcessError(Result(argv, 127, None, str(e), time.time() - start))
+        out, err = proc.communicate()
+    result = Result(argv, proc.returncode, out, err, time.time() - start)
+
+    if log:
+        log.debug('%s finished in %.2fs', os.path.basename(argv[0]), result.duration)
+    if check and result.returncode:
+        raise ProcessError(result)
+    return result
+
+
+def run_all(commands, workers=4, **kwargs):
+    """Run several argvs concurrently, at most workers at a time
+
+    Returns their Results in the order given, failed ones included; the
+    keyword arguments are passed on to run.
+    """
+    if not commands:
+        return []
+
+    kwargs['check'] = False
+    pool = ThreadPool(max(1, min(workers, len(commands))))
+    try:
+        return pool.map(lambda argv: run(argv, **kwargs), commands)
+    finally:
+        pool.close()
+        pool.join()
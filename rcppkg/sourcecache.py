@@ -0,0 +1,152 @@
+import errno
+import fcntl
+import os
+import shutil
+import time
+
+
+# ioctl request to share the extents of a file on btrfs/xfs, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# Unlocked partial downloads older than this are not worth resuming
+PART_MAX_AGE = 24 * 60 * 60
+
+
+def reflink_or_copy(src, dest):
+    with open(src, 'rb') as src_file:
+        with open(dest, 'wb') as dest_file:
+            try:
+                fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+                return
+            except (IOError, OSError):
+                pass
+            shutil.copyfileobj(src_file, dest_file, 1024 * 1024)
+
+
+def remove_stale_part(path):
+    """Remove a partial download no process is writing to
+
+    Empty ones are left behind by failed downloads, old ones by processes
+    that went away.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        stat = os.fstat(fd)
+        if stat.st_size and stat.st_mtime > time.time() - PART_MAX_AGE:
+            return
+        # The lock must be on the file still at path, see download.open_part
+        if os.path.samestat(stat, os.stat(path)):
+            os.remove(path)
+    except (IOError, OSError):
+        pass
+    finally:
+        os.close(fd)
+
+
+def link_or_copy(src, dest):
+    """Hardlink src to dest, falling back to a reflink or a plain copy"""
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        reflink_or_copy(src, dest)
+
+
+class SourceCache(object):
+    """Content-addressed store of source files shared by all workspaces
+
+    Files are stored as <root>/<hashtype>/<hash[:2]>/<hash>, so the same
+    tarball is kept only once no matter how many packages refer to it. The
+    access time of an entry is bumped whenever it is used and the least
+    recently used entries are evicted once the store grows past max_size.
+    """
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+
+    def path(self, hashtype, hash):
+        hash = hash.strip().lower()
+        return os.path.join(self.root, hashtype, hash[:2], hash)
+
+    def has(self, hashtype, hash):
+        return os.path.exists(self.path(hashtype, hash))
+
+    def prepare(self, hashtype, hash):
+        """Return the path an entry should be written to, creating its directory"""
+        path = self.path(hashtype, hash)
+        dir_name = os.path.dirname(path)
+        if not os.path.exists(dir_name):
+            try:
+                os.makedirs(dir_name)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return path
+
+    def link(self, hashtype, hash, dest):
+        path = self.path(hashtype, hash)
+        if os.stat(path).st_mode & 0o222:
+            os.chmod(path, 0o444)
+        link_or_copy(path, dest)
+        # Only the access time is touched, the mtime is shared with workspaces
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+
+    def entries(self):
+        for dir_path, dir_names, file_names in os.walk(self.root):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                if file_name.endswith('.part'):
+                    remove_stale_part(path)
+                    continue
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    continue
+
+    def stats(self):
+        """Return the number of entries, their size and the size still linked"""
+        count = 0
+        size = 0
+        linked = 0
+        for path, stat in self.entries():
+            count += 1
+            if stat.st_nlink == 1:
+                size += stat.st_size
+            else:
+                linked += stat.st_size
+        return count, size, linked
+
+    def prune(self, max_size=None):
+        """Evict least recently used entries until the store fits max_size
+
+        Returns the number of evicted entries and the bytes freed.
+        """
+        if max_size is None:
+            max_size = self.max_size
+
+        entries = sorted((entry for entry in self.entries() if entry[1].st_nlink == 1),
+                         key=lambda entry: entry[1].st_atime)
+        size = sum(stat.st_size for path, stat in entries)
+
+        removed = 0
+        freed = 0
+        for path, stat in entries:
+            if size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= stat.st_size
+            removed += 1
+            freed += stat.st_size
+
+        return removed, freed
@@ -0,0 +1,358 @@
+import hashlib
+import os
+import re
+
+
+TAG_RE = re.compile(r'^([A-Za-z]+)(\d*)\s*:\s*(.*)$')
+DEFINE_RE = re.compile(r'^%(define|global)\s+(\w+)(\(.*?\))?\s+(.*)$')
+WORD_RE = re.compile(r'[!?]*\w+')
+
+# Section headers, the first one ends the preamble of the main package
+SECTIONS = ('%package', '%description', '%prep', '%build', '%install', '%check',
+            '%clean', '%files', '%changelog', '%pre', '%post', '%preun', '%postun',
+            '%pretrans', '%posttrans', '%trigger', '%triggerin', '%triggerun',
+            '%triggerpostun', '%verifyscript')
+CONDITIONALS = ('%if', '%ifarch', '%ifnarch', '%ifos', '%ifnos')
+# Tags whose value can't be trusted when they are set conditionally
+NEVR_TAGS = ('name', 'epoch', 'version', 'release')
+# Other tags rpm defines a lowercase macro for, e.g. %{url}
+MACRO_TAGS = ('summary', 'license', 'url', 'group', 'vendor', 'packager',
+              'distribution', 'vcs', 'bugurl')
+# Built-in macros that need rpm itself to be evaluated
+UNSUPPORTED_MACROS = ('lua', 'expand', 'shrink', 'sub', 'len', 'upper', 'lower',
+                      'suffix', 'dirname', 'basename', 'load', 'undefine',
+                      'echo', 'warn', 'error', 'verbose', 'url2path', 'uncompress')
+
+MAX_DEPTH = 32
+
+# Value of macros set by tags inside conditionals, which only rpm can evaluate
+CONDITIONAL = object()
+
+_cache = {}
+
+
+class SpecParseError(Exception):
+    pass
+
+
+class SpecHeader(object):
+    def __init__(self):
+        self.name = None
+        self.epoch = None
+        self.version = None
+        self.release = None
+        self.url = None
+        self.sources = {}
+        self.patches = {}
+        # ('source' or 'patch', index) of tags set inside conditionals
+        self.conditional = set()
+
+    def source(self, index=0):
+        if ('source', index) in self.conditional:
+            raise SpecParseError('Conditional Source%d tag' % index)
+        return self.sources.get(index)
+
+    def patch(self, index=0):
+        if ('patch', index) in self.conditional:
+            raise SpecParseError('Conditional Patch%d tag' % index)
+        return self.patches.get(index)
+
+
+class SpecDependencies(object):
+    def __init__(self):
+        self.name = None
+        self.build_requires = set()
+        self.provides = set()
+
+
+class MacroExpander(object):
+    def __init__(self, macros):
+        self.macros = dict(macros)
+
+    def define(self, name, value, parametric=False):
+        self.macros[name] = None if parametric else value
+
+    def expand(self, text, depth=0):
+        if depth > MAX_DEPTH:
+            raise SpecParseError('Too deeply nested macros in %r' % text)
+
+        out = []
+        i = 0
+        while i < len(text):
+            if text[i] != '%':
+                out.append(text[i])
+                i += 1
+                continue
+
+            nxt = text[i + 1:i + 2]
+            if nxt == '%':
+                out.append('%')
+                i += 2
+            elif nxt == '{':
+                end = self.find_closing_brace(text, i + 1)
+                out.append(self.expand_macro(text[i + 2:end], depth))
+                i = end + 1
+            elif nxt in ('(', '['):
+                raise SpecParseError('Shell and expression expansion is not supported')
+            else:
+                match = WORD_RE.match(text, i + 1)
+                if not match:
+                    out.append('%')
+                    i += 1
+                    continue
+                out.append(self.expand_macro(match.group(0), depth))
+                i = match.end()
+
+        return ''.join(out)
+
+    def find_closing_brace(self, text, start):
+        depth = 0
+        for i in range(start, len(text)):
+            if text[i] == '{':
+                depth += 1
+            elif text[i] == '}':
+                depth -= 1
+                if depth == 0:
+                    return i
+        raise SpecParseError('Unterminated macro in %r' % text)
+
+    def expand_macro(self, body, depth):
+        prefix = re.match(r'[!?]*', body).group(0)
+        negate = '!' in prefix
+        optional = '?' in prefix
+        name, sep, alternative = body[len(prefix):].partition(':')
+        name = name.strip()
+
+        if name in UNSUPPORTED_MACROS or not re.match(r'^\w+$', name):
+            raise SpecParseError('Unsupported macro %%{%s}' % body)
+
+        defined = name in self.macros
+        if defined and self.macros[name] is None:
+            raise SpecParseError('Parametric macro %%%s is not supported' % name)
+        if defined and self.macros[name] is CONDITIONAL:
+            raise SpecParseError('Macro %%%s is set inside a conditional' % name)
+
+        if optional:
+            if sep:
+                return self.expand(alternative, depth + 1) if defined != negate else ''
+            if negate or not defined:
+                return ''
+        elif sep or not defined:
+            raise SpecParseError('Undefined macro %%{%s}' % body)
+
+        return self.expand(self.macros[name], depth + 1)
+
+
+def read_lines(content):
+    # Macro definitions continue on the next line after a trailing backslash
+    lines = []
+    pending = ''
+    for line in content.splitlines():
+        if line.endswith('\\'):
+            pending += line[:-1] + '\n'
+            continue
+        lines.append(pending + line)
+        pending = ''
+    if pending:
+        lines.append(pending)
+    return lines
+
+
+def parse_header(content, macros=None):
+    """Parse the preamble of the main package of a spec file
+
+    Raises SpecParseError when the header can't be evaluated without rpm,
+    for example when N-E-V-R depends on conditionals or shell expansion, or
+    when the preamble has macro directives other than %define and %global.
+    Sources, patches and the URL set inside conditionals are only rejected
+    when they are used.
+    """
+    expander = MacroExpander(macros or {})
+    header = SpecHeader()
+    conditional_depth = 0
+
+    for line in read_lines(content):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+
+        keyword = stripped.split()[0]
+        if keyword in SECTIONS:
+            break
+        if keyword in CONDITIONALS:
+            conditional_depth += 1
+            continue
+        if keyword == '%else':
+            continue
+        if keyword == '%endif':
+            conditional_depth -= 1
+            continue
+
+        define = DEFINE_RE.match(stripped)
+        if define:
+            if conditional_depth:
+                raise SpecParseError('Conditional macro definition: %s' % stripped)
+            kind, name, params, value = define.groups()
+            if kind == 'global' and not params:
+                value = expander.expand(value.strip())
+            expander.define(name, value.strip(), parametric=bool(params))
+            continue
+
+        # %undefine, %bcond_*, %include, bare %{?...} lines and the like
+        # change what the rest of the header evaluates to
+        if stripped.startswith('%'):
+            raise SpecParseError('Unsupported line in the preamble: %s' % stripped)
+
+        tag = TAG_RE.match(stripped)
+        if not tag:
+            continue
+        tag_name, index, value = tag.group(1).lower(), tag.group(2), tag.group(3).strip()
+
+        if tag_name in NEVR_TAGS:
+            if conditional_depth:
+                raise SpecParseError('Conditional %s tag' % tag.group(1))
+            value = expander.expand(value)
+            setattr(header, tag_name, value)
+            # Tags define the matching macros used by the rest of the spec
+            expander.define(tag_name, value)
+            expander.define(tag_name.upper(), value)
+        elif tag_name in MACRO_TAGS:
+            value = CONDITIONAL if conditional_depth else expander.expand(value)
+            expander.define(tag_name, value)
+            if tag_name == 'url':
+                header.url = None if conditional_depth else value
+        elif tag_name in ('source', 'patch'):
+            tags = header.sources if tag_name == 'source' else header.patches
+            if conditional_depth:
+                header.conditional.add((tag_name, int(index or 0)))
+            else:
+                tags[int(index or 0)] = expander.expand(value)
+
+    for tag_name in ('name', 'version', 'release'):
+        if not getattr(header, tag_name):
+            raise SpecParseError('Missing %s tag' % tag_name.capitalize())
+
+    return header
+
+
+def dependency_names(value):
+    """Return the package names of a comma or space separated dependency list"""
+    # Rich dependencies like (a or b) can't be resolved to a single package
+    if value.startswith('('):
+        return []
+
+    names = []
+    skip_version = False
+    for token in value.replace(',', ' ').split():
+        if skip_version:
+            skip_version = False
+        elif token in ('<', '>', '=', '<=', '>=', '=='):
+            skip_version = True
+        else:
+            names.append(token)
+    return names
+
+
+def parse_dependencies(content, macros=None):
+    """Collect BuildRequires and Provides of all packages of a spec file
+
+    Unlike parse_header this is best effort: conditionals are not evaluated,
+    so dependencies of all branches are collected, and values that can't be
+    expanded are skipped. Subpackage names count as provides.
+    """
+    expander = MacroExpander(macros or {})
+    deps = SpecDependencies()
+    in_preamble = True
+
+    def expand(value):
+        try:
+            return expander.expand(value)
+        except SpecParseError:
+            return None
+
+    for line in read_lines(content):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+
+        words = stripped.split()
+        if words[0] in SECTIONS:
+            in_preamble = words[0] == '%package'
+            if in_preamble and deps.name:
+                # %package foo is <name>-foo, %package -n foo is foo
+                if words[1:2] == ['-n'] and len(words) > 2:
+                    subpackage = expand(words[2])
+                else:
+                    subpackage = expand('%s-%s' % (deps.name, words[-1]))
+                if subpackage:
+                    deps.provides.add(subpackage)
+            continue
+
+        define = DEFINE_RE.match(stripped)
+        if define:
+            kind, name, params, value = define.groups()
+            if kind == 'global' and not params:
+                value = expand(value.strip())
+            if value is not None:
+                expander.define(name, value.strip(), parametric=bool(params))
+            continue
+
+        tag = TAG_RE.match(stripped)
+        if not tag or not in_preamble:
+            continue
+        tag_name = tag.group(1).lower()
+        value = expand(tag.group(3).strip())
+        if value is None:
+            continue
+
+        if tag_name in NEVR_TAGS:
+            expander.define(tag_name, value)
+            expander.define(tag_name.upper(), value)
+            if tag_name == 'name' and not deps.name:
+                deps.name = value
+                deps.provides.add(value)
+        elif tag_name in MACRO_TAGS:
+            expander.define(tag_name, value)
+        elif tag_name == 'buildrequires':
+            deps.build_requires.update(dependency_names(value))
+        elif tag_name == 'provides':
+            deps.provides.update(dependency_names(value))
+
+    return deps
+
+
+def parse_rpmdefines(rpmdefines):
+    """Turn "--define 'name value'" options into a macro dictionary"""
+    macros = {}
+    for define in rpmdefines:
+        if not define.startswith('--define '):
+            continue
+        name, _, value = define[len('--define '):].strip('\'" ').partition(' ')
+        macros[name] = value
+    return macros
+
+
+def parse_spec(path, macros=None):
+    """Parse the header of the spec file at path, caching the result
+
+    Results are reused as long as the file's mtime and size are the same
+    and otherwise as long as its content hash is.
+    """
+    macros = macros or {}
+    key = (os.path.abspath(path), tuple(sorted(macros.items())))
+    stat = os.stat(path)
+    cached = _cache.get(key)
+    if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[3]
+
+    with open(path) as f:
+        content = f.read()
+    digest = hashlib.sha256(content.encode('utf-8') if not isinstance(content, bytes)
+                            else content).hexdigest()
+    if cached and cached[2] == digest:
+        header = cached[3]
+    else:
+        header = parse_header(content, macros)
+
+    _cache[key] = (stat.st_mtime, stat.st_size, digest, header)
+    return header
@@ -0,0 +1,125 @@
+import collections
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+# Nothing is recorded until enable() is called, spans are close to free then
+_enabled = False
+_start = None
+_spans = []
+_counters = collections.defaultdict(int)
+_lock = threading.Lock()
+
+
+def enable():
+    global _enabled, _start
+    _enabled = True
+    _start = time.time()
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    """Stop recording and forget what was recorded, e.g. between daemon commands"""
+    global _enabled, _start
+    with _lock:
+        _enabled = False
+        _start = None
+        del _spans[:]
+        _counters.clear()
+
+
+@contextmanager
+def span(name, **args):
+    """Record the wall time of the block under name"""
+    if not _enabled:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        with _lock:
+            _spans.append((name, start, duration, threading.current_thread().ident, args))
+
+
+def timed(name):
+    """Decorator recording every call of the function as a span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, amount=1):
+    """Add amount to the counter name, e.g. bytes transferred"""
+    if _enabled:
+        with _lock:
+            _counters[name] += amount
+
+
+def time_method(obj, method, name):
+    """Record a span for every call of obj.method, named name(*args, **kwargs)
+
+    Only the instance is patched. This suits objects that route all their
+    remote calls through one method, where a proxy would also wrap plain
+    attributes and flags.
+    """
+    original = getattr(obj, method)
+
+    @functools.wraps(original)
+    def call(*args, **kwargs):
+        with span(name(*args, **kwargs)):
+            return original(*args, **kwargs)
+    setattr(obj, method, call)
+
+
+def summary():
+    """Return [(name, calls, total, max)] sorted by total time, longest first"""
+    totals = collections.OrderedDict()
+    with _lock:
+        spans = list(_spans)
+    for name, start, duration, thread, args in spans:
+        calls, total, longest = totals.get(name, (0, 0.0, 0.0))
+        totals[name] = (calls + 1, total + duration, max(longest, duration))
+    return sorted(((name,) + values for name, values in totals.items()),
+                  key=lambda row: row[2], reverse=True)
+
+
+def report(out=None):
+    """Print the time spent per span name, nested spans are counted in their parents"""
+    out = out or sys.stderr
+    out.write('%-40s %6s %10s %10s %10s\n' % ('Phase', 'Calls', 'Total', 'Average', 'Max'))
+    for name, calls, total, longest in summary():
+        out.write('%-40s %6d %9.3fs %9.3fs %9.3fs\n'
+                  % (name, calls, total, total / calls, longest))
+    for name, value in sorted(_counters.items()):
+        out.write('%-40s %s\n' % (name, value))
+
+
+def write_trace(path):
+    """Write the spans as a Chrome trace, see chrome://tracing"""
+    pid = os.getpid()
+    with _lock:
+        events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': thread,
+                   'ts': int((start - _start) * 1000000), 'dur': int(duration * 1000000),
+                   'args': args}
+                  for name, start, duration, thread, args in _spans]
+        events.extend({'name': name, 'ph': 'C', 'pid': pid, 'tid': 0,
+                       'ts': int((time.time() - _start) * 1000000), 'args': {name: value}}
+                      for name, value in _counters.items())
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
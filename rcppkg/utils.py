@@ -1,58 +1,260 @@
-import git
-import gitlab
+import argparse
+import fnmatch
+import hashlib
+import json
 import os
-import shutil
-import subprocess
 import sys
+import tarfile
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import rcppkg.spec as rcppkg_spec
+import rcppkg.timing as rcppkg_timing
+
+from rcppkg.compress import open_compressed
+
+
+GITLAB_URL = 'GITLAB BASE URL'
+# TODO USERS OWN TOKEN
+GITLAB_TOKEN = 'ACCESS TOKEN'
+# TODO REMOVE GROUP ID HARDCODE
+GITLAB_GROUP_ID = 'GROUP ID'
+# Projects per page of project listings, GitLab allows at most 100
+GITLAB_PER_PAGE = 100
+# Pages of a project listing fetched at the same time
+GITLAB_WORKERS = 4
+
+CACHE_DIR = os.path.expanduser('~/.cache/rcppkg')
+PROJECT_INDEX_PATH = os.path.join(CACHE_DIR, 'projects.json')
+# Index younger than this is used as is, older ones get an incremental refresh
+PROJECT_INDEX_TTL = 60 * 60
+# Incremental refreshes don't see deleted projects, so relist everything daily
+PROJECT_INDEX_FULL_TTL = 24 * 60 * 60
+# How long the spec repo remote head is trusted before asking the remote again
+REMOTE_CHECK_TTL = 5 * 60
+
+# Version control metadata and build output never belong in a source tarball
+SOURCE_EXCLUDES = ['.git', '.svn', '.hg', '.bzr', 'CVS',
+                   'results_*', '*.rpm', '*.o']
+
+
+# (key, object) of the GitLab client and group shared within this process
+_gitlab_connection = (None, None)
+_gitlab_group = (None, None)
+
+
+def get_gitlab_connection(per_page=GITLAB_PER_PAGE, workers=GITLAB_WORKERS):
+    """GitLab client shared by everything in this process
+
+    Its HTTP session keeps up to workers connections to GitLab open between
+    requests, and between the commands of the daemon. A forked process gets
+    a client of its own as pooled connections can't be shared with the
+    parent.
+    """
+    global _gitlab_connection
+    key = (os.getpid(), GITLAB_URL, GITLAB_TOKEN, per_page, workers)
+    if _gitlab_connection[0] != key:
+        import gitlab
+        import rcppkg.download as rcppkg_download
+
+        session = rcppkg_download.get_http_session(max(1, workers))
+        _gitlab_connection = (key, gitlab.Gitlab(GITLAB_URL, GITLAB_TOKEN,
+                                                 per_page=per_page, session=session))
+    return _gitlab_connection[1]
+
+
+def get_gitlab_group(per_page=GITLAB_PER_PAGE, workers=GITLAB_WORKERS):
+    global _gitlab_group
+    gl = get_gitlab_connection(per_page, workers)
+    key = (gl, GITLAB_GROUP_ID)
+    if _gitlab_group[0] != key:
+        # Only its projects are used, which needs the id but no group lookup
+        _gitlab_group = (key, gl.groups.get(GITLAB_GROUP_ID, lazy=True))
+    return _gitlab_group[1]
+
+
+def list_group_projects(group, per_page=GITLAB_PER_PAGE, workers=GITLAB_WORKERS, **filters):
+    """Attributes of all projects of group, optionally filtered, as dicts
+
+    The first page tells how many pages there are, the others are then
+    fetched workers at a time.
+    """
+    gl = group.manager.gitlab
+    path = group.projects.path
+
+    def fetch(page):
+        query = dict(filters, page=page, per_page=per_page)
+        return gl.http_get(path, query_data=query, raw=True)
+
+    response = fetch(1)
+    projects = response.json()
+    total_pages = response.headers.get('X-Total-Pages')
+    if not total_pages:
+        # GitLab leaves the totals out of very large listings, walk them in order
+        while response.headers.get('X-Next-Page'):
+            response = fetch(int(response.headers['X-Next-Page']))
+            projects.extend(response.json())
+        return projects
+
+    pages = list(range(2, int(total_pages) + 1))
+    if pages:
+        pool = ThreadPool(max(1, min(workers, len(pages))))
+        try:
+            for page_projects in pool.map(lambda page: fetch(page).json(), pages):
+                projects.extend(page_projects)
+        finally:
+            pool.close()
+            pool.join()
+    return projects
+
+
+def write_file_atomic(path, text):
+    dir_name = os.path.dirname(path)
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.rename(tmp_path, path)
+
+
+def write_json_atomic(path, data):
+    write_file_atomic(path, json.dumps(data))
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def project_index_entry(project):
+    return {'name': project['name'],
+            'id': project['id'],
+            'path': project['path'],
+            'last_activity': project.get('last_activity_at')}
+
+
+@rcppkg_timing.timed('gitlab project index')
+def refresh_project_index(index=None, full=False, per_page=GITLAB_PER_PAGE,
+                          workers=GITLAB_WORKERS):
+    group = get_gitlab_group(per_page, workers)
+    now = time.time()
+
+    if index is None or full:
+        projects = list_group_projects(group, per_page, workers)
+        index = {'full_refresh': now, 'projects': {}}
+    else:
+        # Only projects touched since the last refresh need to be listed
+        activity = [p['last_activity'] for p in index['projects'].values()
+                    if p['last_activity']]
+        if activity:
+            projects = list_group_projects(group, per_page, workers,
+                                           last_activity_after=max(activity))
+        else:
+            projects = list_group_projects(group, per_page, workers)
 
-from distutils.dir_util import copy_tree
-from HTMLParser import HTMLParser
+    for project in projects:
+        index['projects'][project['name']] = project_index_entry(project)
+    index['refreshed'] = now
 
+    write_json_atomic(PROJECT_INDEX_PATH, index)
+    return index
 
-def get_gitlab_connection():
-    # TODO USERS OWN TOKEN
-    return gitlab.Gitlab('GITLAB BASE URL', 'ACCESS TOKEN')
 
+def load_project_index(refresh=False, per_page=GITLAB_PER_PAGE, workers=GITLAB_WORKERS):
+    index = read_json(PROJECT_INDEX_PATH)
+    if refresh or not index or 'projects' not in index:
+        return refresh_project_index(None, True, per_page, workers)
 
-def get_gitlab_group():
-    gl = get_gitlab_connection()
-    # TODO REMOVE GROUP ID HARDCODE
-    return gl.groups.get('GROUP ID')
+    now = time.time()
+    if now - index.get('full_refresh', 0) > PROJECT_INDEX_FULL_TTL:
+        return refresh_project_index(None, True, per_page, workers)
+    if now - index.get('refreshed', 0) > PROJECT_INDEX_TTL:
+        return refresh_project_index(index, False, per_page, workers)
 
+    return index
 
-def get_matching_packages(search_word):
-    group = get_gitlab_group()
-    projects = group.projects.list(all=True)
 
-    matches = []
-    for project in projects:
-        if search_word.lower() in project.name.lower():
-            matches.append(project)
-    return matches
+def get_matching_packages(search_word, refresh=False, per_page=GITLAB_PER_PAGE,
+                          workers=GITLAB_WORKERS):
+    projects = load_project_index(refresh, per_page, workers)['projects']
 
+    search_word = search_word.lower()
+    return [projects[name] for name in sorted(projects)
+            if search_word in name.lower()]
 
-def get_repository(search_word):
-    matches = get_matching_packages(search_word)
-    for match in matches:
-        if search_word == match.name:
-            return match
+
+@rcppkg_timing.timed('get_repository')
+def get_repository(name, refresh=False, per_page=GITLAB_PER_PAGE, workers=GITLAB_WORKERS):
+    index = load_project_index(refresh, per_page, workers)
+    if name in index['projects']:
+        return index['projects'][name]
+
+    # The project may have been created after the index was last refreshed
+    if not refresh:
+        index = refresh_project_index(index, False, per_page, workers)
+        if name in index['projects']:
+            return index['projects'][name]
 
     return False
 
 
-def remote_updates_available(module_build_dir):
+def get_remote_head(repo, ttl):
+    try:
+        tracking = repo.active_branch.tracking_branch()
+    except TypeError:
+        # Detached HEAD
+        tracking = None
+    if tracking:
+        remote, ref = tracking.remote_name, 'refs/heads/%s' % tracking.remote_head
+    else:
+        remote, ref = 'origin', 'HEAD'
+
+    cache_path = os.path.join(repo.git_dir, 'rcppkg-remote-head')
+    cached = read_json(cache_path)
+    if cached and cached.get('ref') == ref and time.time() - cached['checked'] < ttl:
+        return cached['head']
+
+    output = repo.git.ls_remote(remote, ref)
+    head = output.split()[0] if output else None
+    write_json_atomic(cache_path, {'ref': ref, 'head': head, 'checked': time.time()})
+    return head
+
+
+@rcppkg_timing.timed('remote_updates_available')
+def remote_updates_available(module_build_dir, ttl=REMOTE_CHECK_TTL):
     if not os.path.exists(module_build_dir):
         return False
-        
-    os.system('git -C %s remote update' % module_build_dir)
-    git_cmd = 'git -C %s status -uno' % module_build_dir
-    if 'branch is behind' in subprocess.check_output([git_cmd], shell=True, stderr=subprocess.STDOUT):
-        return True
 
-    return False
+    import git
+
+    repo = git.Repo(module_build_dir)
+    remote_head = get_remote_head(repo, ttl)
+    local_head = repo.head.commit.hexsha
+    if not remote_head or remote_head == local_head:
+        return False
+
+    # Local commits on top of the remote head don't make the branch behind
+    try:
+        return not repo.is_ancestor(remote_head, local_head)
+    except git.GitCommandError:
+        # The remote head hasn't been fetched, so it must be newer
+        return True
 
 
 def get_git_url_from_specfile(specfile_path):
+    try:
+        url = rcppkg_spec.parse_spec(specfile_path).url
+    except rcppkg_spec.SpecParseError:
+        url = None
+    if url:
+        return url
+
     with open(specfile_path) as specfile:
         for line in specfile:
             if 'URL:' in line:
@@ -64,7 +266,13 @@ def get_git_url_from_specfile(specfile_path):
 
 
 def get_source_from_specfile(module_name, version, specfile_path):
-    file_extension = None
+    try:
+        source = rcppkg_spec.parse_spec(specfile_path).source(0)
+    except rcppkg_spec.SpecParseError:
+        source = None
+    if source:
+        return source.split('/')[-1]
+
     with open(specfile_path) as specfile:
         for line in specfile:
             if 'Source:' in line or 'Source0:' in line:
@@ -79,6 +287,22 @@ def get_source_from_specfile(module_name, version, specfile_path):
     sys.exit(0)
 
 
+def parse_size(size):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    for unit in ['B', 'K', 'M', 'G']:
+        if size < 1024:
+            return '%.1f%s' % (size, unit)
+        size /= 1024.0
+    return '%.1fT' % size
+
+
 def get_file_extension_from_name(tarball_name):
     if tarball_name[-3:] == '.gz' or tarball_name[-3:] == '.xz':
         return tarball_name[-7:]
@@ -90,62 +314,158 @@ def get_file_extension_from_name(tarball_name):
     return ''
 
 
-def compress_to_dir(target_dir, tarball_name, source_dir, file_extension):
-    tar_opt = ''
-    if file_extension == '.tar.gz' or file_extension == '.tgz':
-        tar_opt = '-czf'
-    elif file_extension == '.tar.xz':
-        tar_opt = '-cJf'
-    elif file_extension == '.tar.bz2':
-        tar_opt = '-cjf'
+def is_excluded(path):
+    name = os.path.basename(path)
+    return any(fnmatch.fnmatch(name, pattern) for pattern in SOURCE_EXCLUDES)
+
+
+def walk_source_tree(curdir):
+    """Yield the paths to archive below curdir, relative to it and sorted"""
+    for dir_path, dir_names, file_names in os.walk(curdir):
+        dir_names[:] = sorted(name for name in dir_names if not is_excluded(name))
+        rel_dir = os.path.relpath(dir_path, curdir)
+        for name in sorted(dir_names + [name for name in file_names if not is_excluded(name)]):
+            yield os.path.normpath(os.path.join(rel_dir, name))
+
+
+def build_source_manifest(curdir, previous_files=None):
+    # Content hashes of files whose mtime and size are unchanged are reused
+    # from the previous manifest, so only modified files are read
+    previous = dict((entry[0], entry) for entry in previous_files or [])
+
+    files = []
+    for rel_path in walk_source_tree(curdir):
+        path = os.path.join(curdir, rel_path)
+        stat = os.lstat(path)
+        old = previous.get(rel_path)
+        if os.path.islink(path):
+            content_hash = os.readlink(path)
+        elif os.path.isdir(path):
+            content_hash = None
+        elif old and old[1:4] == [stat.st_mode, stat.st_mtime, stat.st_size]:
+            content_hash = old[4]
+        else:
+            content_hash = get_checksum('sha256', path)
+        files.append([rel_path, stat.st_mode, stat.st_mtime, stat.st_size, content_hash])
+
+    return files
+
+
+def manifest_matches(manifest, previous):
+    if not previous or previous.get('archive') != manifest['archive']:
+        return False
+    if len(previous.get('files', [])) != len(manifest['files']):
+        return False
+
+    # Reproducible archives don't contain mtimes, so those may change freely
+    ignore_mtime = manifest['archive']['reproducible']
+    for entry, old in zip(manifest['files'], previous['files']):
+        if ignore_mtime:
+            entry, old = entry[:2] + entry[3:], old[:2] + old[3:]
+        if entry != old:
+            return False
+    return True
 
-    tar_cmd = 'tar -C %s %s %s %s' % (target_dir, tar_opt, tarball_name, source_dir)
-    os.system(tar_cmd)
 
+@rcppkg_timing.timed('create_source_package')
+def create_source_package(curdir, module_build_dir, specfile_path, source_name,
+                          compress_level=None, compress_threads=None, reproducible=False):
+    """Archive curdir as source_name into module_build_dir
 
-def create_source_package(curdir, module_build_dir, specfile_path, source_name):
-    source_target_dir = '/'.join(specfile_path.split('/')[:-1])
+    Returns False without touching the archive if nothing changed since it
+    was last created.
+    """
     file_extension = get_file_extension_from_name(source_name)
 
     source_package = "%s/%s" % (module_build_dir, source_name)
     source_dir = source_name.replace(file_extension, '')
-    
-    tmp_source_dir = "%s/%s" % (source_target_dir, source_dir)
-
-    if os.path.exists(tmp_source_dir):
-        shutil.rmtree(tmp_source_dir)
-    if os.path.exists(source_package):
-        os.remove(source_package)
-
-    os.makedirs(tmp_source_dir)
-    copy_tree(curdir, tmp_source_dir)
-    compress_to_dir(source_target_dir, source_package, source_dir, file_extension)
+    tmp_package = '%s.tmp' % source_package
+    manifest_path = '%s.manifest' % source_package
+
+    previous = read_json(manifest_path) if os.path.exists(source_package) else None
+    manifest = {'archive': {'source_dir': source_dir,
+                            'compress_level': compress_level,
+                            'reproducible': reproducible},
+                'files': build_source_manifest(curdir, previous and previous.get('files'))}
+    if manifest_matches(manifest, previous):
+        return False
 
-    shutil.rmtree(tmp_source_dir)
+    source_date = int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+
+    def normalize(tarinfo):
+        if reproducible:
+            tarinfo.mtime = min(tarinfo.mtime, source_date)
+            tarinfo.uid = tarinfo.gid = 0
+            tarinfo.uname = tarinfo.gname = 'root'
+        return tarinfo
+
+    # The working directory is streamed into the archive as is, only the
+    # top level directory is renamed to match what the spec file expects
+    archive_file = open_compressed(tmp_package, file_extension,
+                                   compress_level, compress_threads, reproducible)
+    try:
+        try:
+            with tarfile.open(fileobj=archive_file, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+                tar.add(curdir, arcname=source_dir, recursive=False, filter=normalize)
+                for entry in manifest['files']:
+                    tar.add(os.path.join(curdir, entry[0]),
+                            arcname=os.path.join(source_dir, entry[0]),
+                            recursive=False, filter=normalize)
+        finally:
+            archive_file.close()
+    except Exception:
+        os.remove(tmp_package)
+        raise
+
+    os.rename(tmp_package, source_package)
+    write_json_atomic(manifest_path, manifest)
+    return True
+
+
+def parse_package_spec(package):
+    # <package> or <package>@<spec file commit hash>
+    name, _, version_hash = package.partition('@')
+    return name, version_hash or None
+
+
+def parse_matrix_combo(combo):
+    # <target>:<arch> or <target>:<arch>:<dist>, used as an argparse type
+    fields = combo.split(':')
+    if len(fields) not in (2, 3) or not all(fields):
+        raise argparse.ArgumentTypeError('Expected TARGET:ARCH[:DIST], got %r' % combo)
+    return fields[0], fields[1], fields[2] if len(fields) == 3 else None
+
+
+def available_memory():
+    # MemAvailable of /proc/meminfo in bytes, None when it can't be read
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def read_package_manifest(manifest_path):
+    # One package per line, optionally followed by a spec file commit hash
+    packages = []
+    with open(manifest_path) as manifest:
+        for line in manifest:
+            fields = line.split('#')[0].split()
+            if fields:
+                packages.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return packages
 
 
 def get_local_spec_head(module_build_dir):
+    import git
+
     repo = git.Repo(module_build_dir)
     return repo.heads[0].commit.hexsha
 
 
-def find_link_tails(tails, file_name, url):
-    curl_cmd = "curl %s" % url
-    index = subprocess.check_output([curl_cmd], shell=True, stderr=subprocess.STDOUT)
-    parser = LinkHTMLParser()
-    parser.feed(index)
-
-    start_index = find_files_start(parser.links)
-    files = parser.links[start_index:]
-
-    for file in files:
-        new_url = '%s%s' % (url, file)
-        if (file == file_name):
-            tails.append(new_url)
-        else:
-            find_link_tails(tails, file_name, new_url)
-
-
 def find_files_start(files):
     for file in files:
         if '/repo/pkgs/' in file:
@@ -154,24 +474,35 @@ def find_files_start(files):
     return -1
 
 
+def get_checksum(hashtype, file):
+    hasher = hashlib.new(hashtype)
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
 def compare_checksum(hashtype, stored_hash, file):
-    hash_cmd = ''
-    if hashtype == 'md5':
-        hash_cmd = "md5sum %s | cut -d ' ' -f1" % file
-    elif hashtype == 'sha512':
-        hash_cmd = "sha512sum %s | cut -d ' ' -f1" % file
-    checksum = subprocess.check_output([hash_cmd], shell=True, stderr=subprocess.STDOUT)
-
-    if stored_hash.strip() != checksum.strip():
+    checksum = get_checksum(hashtype, file)
+
+    if stored_hash.strip().lower() != checksum:
         print("Checksum mismatch detected. Deleting faulty file.")
         os.remove(file)
+        return False
+
+    return True
+
+
+def link_html_parser():
+    from six.moves.html_parser import HTMLParser
 
+    class LinkHTMLParser(HTMLParser):
+        def __init__(self):
+            HTMLParser.__init__(self)
+            self.links = []
 
-class LinkHTMLParser(HTMLParser):
-    def __init__(self):
-        HTMLParser.__init__(self)
-        self.links = []
+        def handle_starttag(self, tag, attrs):
+            if tag == 'a':
+                self.links.append(attrs[0][1])
 
-    def handle_starttag(self, tag, attrs):
-        if tag == 'a':
-            self.links.append(attrs[0][1])
+    return LinkHTMLParser()
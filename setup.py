@@ -16,10 +16,9 @@ setup(
                 ('/etc/rpkg', ['etc/rpkg/rcppkg.conf'])],
     install_requires=[
             'GitPython',
-            'wget',
             'python-gitlab',
-            'HTMLParser',
             'ndg-httpsclient',
-            'requests'
+            'requests',
+            'six'
     ]
 )
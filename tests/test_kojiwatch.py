@@ -0,0 +1,81 @@
+import os
+import sys
+import unittest
+
+import six
+
+try:
+    import koji
+except ImportError:
+    koji = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'bench'))
+
+import servers  # noqa: E402
+from rcppkg.kojiwatch import (TASK_CLOSED, TASK_FAILED, TaskWatcher,  # noqa: E402
+                              get_task_infos)
+
+TASK_OPEN = 1
+TASK_FREE = 0
+
+
+def task(task_id, state, method='build'):
+    return {'id': task_id, 'state': state, 'method': method}
+
+
+@unittest.skipUnless(koji, 'koji is not installed')
+class TaskWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = servers.FakeKojiHub()
+        self.session = koji.ClientSession(self.hub.url)
+        self.hub.tasks[1] = (task(1, TASK_OPEN), [task(11, TASK_OPEN, 'buildArch'),
+                                                  task(12, TASK_FREE, 'buildArch')])
+        self.hub.tasks[2] = (task(2, TASK_FREE), [])
+        self.out = six.StringIO()
+
+    def tearDown(self):
+        self.hub.stop()
+
+    def test_missing_task_is_failed(self):
+        infos = get_task_infos(self.session, [1, 5000], children=True)
+        self.assertEqual(infos[1]['state'], TASK_OPEN)
+        self.assertEqual(len(infos[1]['children']), 2)
+        self.assertEqual(infos[5000]['state'], TASK_FAILED)
+        self.assertEqual(infos[5000]['children'], [])
+
+    def test_state_changes(self):
+        watcher = TaskWatcher(self.session, [1, 2], out=self.out)
+        self.assertTrue(watcher.poll())
+        self.assertFalse(watcher.poll())
+        self.assertIn('(1 free, 1 open)', watcher.format_line(1))
+
+        # A child changing state is a change of its parent too
+        self.hub.tasks[1][1][1]['state'] = TASK_OPEN
+        self.assertTrue(watcher.poll())
+        self.assertIn('(2 open)', watcher.format_line(1))
+
+        self.hub.tasks[2] = (task(2, TASK_CLOSED), [])
+        self.assertTrue(watcher.poll())
+        self.assertEqual(watcher.unfinished(), [1])
+
+    def test_watch(self):
+        self.hub.tasks[1] = (task(1, TASK_CLOSED), [task(11, TASK_CLOSED, 'buildArch')])
+        self.hub.tasks[2] = (task(2, TASK_CLOSED), [])
+        watcher = TaskWatcher(self.session, [1, 2, 5000], min_interval=0.01, out=self.out)
+        self.assertEqual(watcher.watch(), 1)
+        self.assertEqual(watcher.failed(), [5000])
+        self.assertIn('unknown task', self.out.getvalue())
+        self.assertIn('Task 5000 failed', self.out.getvalue())
+
+    def test_fail_fast(self):
+        self.hub.tasks[2] = (task(2, TASK_FAILED), [])
+        watcher = TaskWatcher(self.session, [1, 2], fail_fast=True, min_interval=0.01,
+                              out=self.out)
+        self.assertEqual(watcher.watch(), 1)
+        self.assertEqual(watcher.unfinished(), [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
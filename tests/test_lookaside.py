@@ -0,0 +1,71 @@
+import collections
+import os
+import sys
+import unittest
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'bench'))
+
+import servers  # noqa: E402
+import rcppkg.lookaside as rcppkg_lookaside  # noqa: E402
+
+
+Entry = collections.namedtuple('Entry', ['file', 'hashtype', 'hash'])
+
+SIZE = 3 * 1024 * 1024 + 17
+
+
+class UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fedora = servers.FakeLookaside({'foo': [('foo-1.0.tar.gz', SIZE),
+                                                     ('foo-data.tar.gz', 1024)]})
+        self.lookaside = servers.FakeLookaside({})
+        self.cgi_url = '%s/upload.cgi' % self.lookaside.url
+        self.session = requests.Session()
+
+    def tearDown(self):
+        self.session.close()
+        self.fedora.stop()
+        self.lookaside.stop()
+
+    def source(self, name, size):
+        digest = servers.content_hash('foo/%s' % name, size)
+        url = '%s/repo/pkgs/foo/%s/sha512/%s/%s' % (self.fedora.url, name, digest, name)
+        return Entry(name, 'sha512', digest), url
+
+    def test_upload_intact(self):
+        entry, url = self.source('foo-1.0.tar.gz', SIZE)
+        rcppkg_lookaside.upload_stream(self.session, self.cgi_url, 'foo', entry, url)
+        # The stand-in only stores files matching the posted checksum
+        self.assertEqual(self.lookaside.uploaded, set([('foo', entry.file, entry.hash)]))
+
+    def test_bad_checksum_aborts(self):
+        entry, url = self.source('foo-1.0.tar.gz', SIZE)
+        entry = entry._replace(hash='0' * 128)
+        with self.assertRaises(rcppkg_lookaside.UploadError) as cm:
+            rcppkg_lookaside.upload_stream(self.session, self.cgi_url, 'foo', entry, url)
+        # Raised by the client before the end of the form, not by the CGI
+        self.assertIn('does not match its sha512 checksum', str(cm.exception))
+        self.assertEqual(self.lookaside.uploaded, set())
+
+    def test_present_files_skipped(self):
+        present, present_url = self.source('foo-1.0.tar.gz', SIZE)
+        missing, missing_url = self.source('foo-data.tar.gz', 1024)
+        rcppkg_lookaside.upload_stream(self.session, self.cgi_url, 'foo', present, present_url)
+
+        entries = rcppkg_lookaside.missing_entries(self.session, self.cgi_url, 'foo',
+                                                   [present, missing])
+        self.assertEqual(entries, [missing])
+
+        errors = rcppkg_lookaside.upload_all(self.session, self.cgi_url, 'foo',
+                                             [(missing, missing_url)])
+        self.assertEqual(errors, [(missing, None)])
+        self.assertEqual(rcppkg_lookaside.missing_entries(self.session, self.cgi_url, 'foo',
+                                                          [present, missing]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
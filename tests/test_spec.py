@@ -0,0 +1,110 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+import rcppkg.spec as rcppkg_spec
+
+
+MACROS = {'dist': '.el7'}
+
+PREAMBLE = '''Name: foo
+Version: 1.0
+%s
+Summary: Test package
+License: MIT
+URL: https://example.com/foo
+Source0: %%{url}/foo-%%{version}.tar.gz
+
+%%description
+Test package
+'''
+
+# Spec preambles whose N-V-R the parser must evaluate like rpm does
+SUPPORTED = {
+    'plain': 'Release: 1%{?dist}',
+    'global': '%global rel 3\nRelease: %{rel}%{?dist}',
+    'define': '%define rel 3\nRelease: %{rel}%{?dist}',
+    'optional': 'Release: 1%{?snapshot:.git}%{!?snapshot:.rel}',
+}
+
+# Spec preambles the parser must leave to rpm
+UNSUPPORTED = {
+    'undefine': '%undefine dist\nRelease: 1%{?dist}',
+    'bcond': '%bcond_without tests\nRelease: 1%{?with_tests:.t}',
+    'bare macro': '%{!?rel: %global rel 5}\nRelease: %{rel}',
+    'include': '%include %{_sourcedir}/release.inc\nRelease: 1',
+    'elif': '%if 0\n%elif 1\n%endif\nRelease: 1',
+}
+
+
+def rpm_nvr(path, macros):
+    cmd = ['rpm']
+    for name, value in sorted(macros.items()):
+        cmd.extend(['--define', '%s %s' % (name, value)])
+    cmd.extend(['-q', '--qf', '%{NAME} %{VERSION} %{RELEASE}??', '--specfile', path])
+    output = subprocess.check_output(cmd).decode('utf-8')
+    return tuple(output.split('??')[0].split())
+
+
+class ParseHeaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_spec(self, release):
+        path = os.path.join(self.tmpdir, 'foo.spec')
+        with open(path, 'w') as f:
+            f.write(PREAMBLE % release)
+        # The included file of the include case
+        with open(os.path.join(self.tmpdir, 'release.inc'), 'w') as f:
+            f.write('%global dist .inc\n')
+        return path
+
+    def parse(self, release):
+        with open(self.write_spec(release)) as f:
+            return rcppkg_spec.parse_header(f.read(), dict(MACROS, _sourcedir=self.tmpdir))
+
+    def test_supported(self):
+        for case, release in sorted(SUPPORTED.items()):
+            header = self.parse(release)
+            self.assertEqual(header.name, 'foo', case)
+            self.assertEqual(header.source(0), 'https://example.com/foo/foo-1.0.tar.gz', case)
+
+    def test_unsupported(self):
+        for case, release in sorted(UNSUPPORTED.items()):
+            self.assertRaises(rcppkg_spec.SpecParseError, self.parse, release)
+
+    def test_conditional_source(self):
+        header = self.parse('Release: 1\n%if 0%{?rhel}\nSource1: el.tar.gz\n%endif')
+        self.assertRaises(rcppkg_spec.SpecParseError, header.source, 1)
+
+    @unittest.skipUnless(which('rpm'), 'rpm is not installed')
+    def test_matches_rpm(self):
+        for case, release in sorted(SUPPORTED.items()):
+            header = self.parse(release)
+            macros = dict(MACROS, _sourcedir=self.tmpdir)
+            self.assertEqual((header.name, header.version, header.release),
+                             rpm_nvr(self.write_spec(release), macros), case)
+
+    @unittest.skipUnless(which('rpm'), 'rpm is not installed')
+    def test_unsupported_differs_from_naive_parse(self):
+        # What a parser skipping the unsupported lines would get wrong
+        naive = {'undefine': '1.el7', 'bcond': '1'}
+        for case in sorted(naive):
+            macros = dict(MACROS, _sourcedir=self.tmpdir)
+            nvr = rpm_nvr(self.write_spec(UNSUPPORTED[case]), macros)
+            self.assertNotEqual(nvr[2], naive[case], case)
+
+
+if __name__ == '__main__':
+    unittest.main()